@@ -14,3 +14,10 @@ max_requests = os.getenv("MAX_REQUESTS")
 max_requests_jitter = os.getenv("MAX_REQUESTS_JITTER")
 proc_name = os.getenv("SUPERVISOR_PROCESS_NAME")
 reload = bool(os.getenv("RELOAD", False))
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -3,19 +3,24 @@
 import os
 import smtplib
 import logging
+import orjson
 import requests
 import flask_mongorest.operators as ops
 
 from email.message import EmailMessage
+from functools import partial
 from importlib import import_module
 from importlib.metadata import version
 from websocket import create_connection
 from flask import Flask, current_app, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_marshmallow import Marshmallow
 from flask_mongoengine import MongoEngine
 from flask_mongorest import register_class
+from flask_mongorest.utils import encode_default
 from flask_sse import sse
 from flask_compress import Compress
+from flask_rq2 import RQ
 from flasgger.base import Swagger
 
 from mongoengine import ValidationError
@@ -37,6 +42,13 @@ delimiter, max_depth = ".", 7  # = MAX_NESTING + 2 from client
 invalidChars = set(punctuation.replace("*", "").replace("|", "") + whitespace)
 is_gunicorn = "gunicorn" in os.environ.get("SERVER_SOFTWARE", "")
 SMTP_HOST, SMTP_PORT = os.environ.get("SMTP_SERVER", "localhost:587").split(":")
+MPCONTRIBS_API_HOST = os.environ.get("MPCONTRIBS_API_HOST", "default")
+
+# NOTE stats queue listed first for workers to pick up short stats jobs before notebook builds
+rq = RQ()
+rq.default_queue = f"notebooks_{MPCONTRIBS_API_HOST}"
+STATS_QUEUE = f"stats_{MPCONTRIBS_API_HOST}"
+rq.queues = [STATS_QUEUE, rq.default_queue]
 
 # NOTE not including Size below (special for arrays)
 FILTERS = {
@@ -190,24 +202,56 @@ def get_consumer():
     }
 
 
-def create_app():
-    """create flask app"""
-    app = Flask(__name__)
-    app.config.from_pyfile("config.py", silent=True)
-    app.config["USTS"] = URLSafeTimedSerializer(app.secret_key)
-    app.jinja_env.globals["get_resource_as_string"] = get_resource_as_string
-    app.jinja_env.lstrip_blocks = True
-    app.jinja_env.trim_blocks = True
-    app.json.sort_keys = False
-    MPCONTRIBS_API_HOST = app.config.get("MPCONTRIBS_API_HOST")
-    app.config["TEMPLATE"]["schemes"] = ["http"] if app.debug else ["https"]
-    logger.info("database: " + app.config["MPCONTRIBS_DB"])
-    Compress(app)
-    Marshmallow(app)
-    MongoEngine(app)
-    Swagger(app, template=app.config.get("TEMPLATE"))
-    setattr(app, "kernels", get_kernels())
+def is_admin():
+    """whether current request is from a member of the admin group"""
+    groups = get_consumer()["groups"].split(",")
+    return os.environ.get("ADMIN_GROUP", "admin") in {grp.strip() for grp in groups}
+
+
+def orjson_default(value, fallback=DefaultJSONProvider.default):
+    encoded = encode_default(value)
+    if encoded is value:
+        # dates, UUIDs, dataclasses etc. as in the app's original provider
+        return fallback(value)
+
+    return encoded
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider using orjson for jsonify and blueprint responses"""
+
+    def __init__(self, app, fallback=DefaultJSONProvider.default):
+        super().__init__(app)
+        self._default = partial(orjson_default, fallback=fallback)
+
+    def dumpb(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+
+        return orjson.dumps(obj, default=self._default, option=option)
 
+    def dumps(self, obj, **kwargs):
+        return self.dumpb(obj, **kwargs).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # skip decoding to str and use bytes as response body directly
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        body = self.dumpb(obj, indent=indent) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+JSON_PROVIDERS = {"default": DefaultJSONProvider, "orjson": OrjsonProvider}
+
+
+def register_views(app):
+    """register blueprints and flask-mongorest views for all collections"""
     # NOTE: hard-code to avoid pre-generating for new deployment
     # collections = get_collections(db)
     collections = [
@@ -236,10 +280,45 @@ def create_app():
         except AttributeError as ex:
             logger.error(f"Failed to register {module_path}: {collection} {ex}")
 
-    if getattr(app, "kernels", None):
-        from mpcontribs.api.notebooks.views import rq
 
-        rq.init_app(app)
+def create_app():
+    """create flask app"""
+    app = Flask(__name__)
+    app.config.from_pyfile("config.py", silent=True)
+    app.config["USTS"] = URLSafeTimedSerializer(app.secret_key)
+    app.jinja_env.globals["get_resource_as_string"] = get_resource_as_string
+    app.jinja_env.lstrip_blocks = True
+    app.jinja_env.trim_blocks = True
+    MPCONTRIBS_API_HOST = app.config.get("MPCONTRIBS_API_HOST")
+    app.config["TEMPLATE"]["schemes"] = ["http"] if app.debug else ["https"]
+    logger.info("database: " + app.config["MPCONTRIBS_DB"])
+    Compress(app)
+    Marshmallow(app)
+    # NOTE metrics before MongoEngine to monitor commands of its client
+    from mpcontribs.api.metrics import init_metrics
+    from mpcontribs.api.slow_queries import init_slow_queries
+
+    init_metrics(app)
+    init_slow_queries(app)
+    MongoEngine(app)
+    # NOTE flask-mongoengine's provider also serializes documents and ObjectIds
+    provider = type(app.json)
+    if app.config.get("JSON_PROVIDER", "orjson") == "orjson":
+        app.json = OrjsonProvider(app, fallback=provider.default)
+    else:
+        app.json = provider(app)
+
+    app.json.sort_keys = False
+    Swagger(app, template=app.config.get("TEMPLATE"))
+    setattr(app, "kernels", get_kernels())
+    register_views(app)
+    rq.init_app(app)
+    # NOTE response cache hooks registered after Compress to cache uncompressed responses
+    from mpcontribs.api.cache import init_cache
+    from mpcontribs.api.apispec import init_apispec
+
+    init_cache(app)
+    init_apispec(app)
 
     def healthcheck():
         return jsonify({"version": app.config["VERSION"]})
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Swagger spec precomputed at build time and served gzip-compressed
+
+Build (in the docker image) with `python -m mpcontribs.api.apispec`. Workers then
+skip generating marshmallow definitions and YAML specs on start (see SwaggerView)
+and serve the versioned artifact for /apispec.json instead of flasgger's loader.
+"""
+import os
+import gzip
+
+from hashlib import md5
+from flask import Flask, request, abort
+from flasgger import Swagger
+
+from mpcontribs.api import register_views, get_logger
+from mpcontribs.api.config import APISPEC_PATH, VERSION
+
+logger = get_logger(__name__)
+MAX_AGE = int(os.environ.get("APISPEC_MAX_AGE", 3600))  # seconds, unversioned route
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def build_apispec(path=APISPEC_PATH):
+    """generate swagger spec via flasgger and save gzip-compressed"""
+    from mpcontribs.api.core import SwaggerView
+
+    # no database connection or kernels needed to generate specs
+    app = Flask("mpcontribs.api")
+    app.config.from_pyfile("config.py", silent=True)
+    app.config["TEMPLATE"]["schemes"] = ["https"]
+    Swagger(app, template=app.config.get("TEMPLATE"))
+    register_views(app)
+
+    for klass in SwaggerView.__subclasses__():
+        if hasattr(klass, "schema_name"):
+            klass.generate_specs()
+
+    with app.test_client() as client:
+        resp = client.get("/apispec.json")
+        if resp.status_code != 200:
+            raise RuntimeError(f"failed to generate spec: {resp.status_code}")
+
+        body = resp.get_data()
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(gzip.compress(body, compresslevel=9, mtime=0))
+
+    os.replace(tmp, path)
+    return path
+
+
+def init_apispec(app):
+    """serve precomputed spec for /apispec.json and versioned /apispec-<version>.json"""
+    if not os.path.exists(APISPEC_PATH):
+        logger.warning(f"{APISPEC_PATH} not found, generating specs on demand")
+        return
+
+    with open(APISPEC_PATH, "rb") as f:
+        compressed = f.read()
+
+    etag = md5(compressed).hexdigest()
+    body = gzip.decompress(compressed)
+
+    def apispec(version=None):
+        if version is not None and version != VERSION:
+            abort(404, description=f"spec for {version} not available ({VERSION})")
+
+        if "gzip" in request.accept_encodings:
+            response = app.response_class(compressed, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = app.response_class(body, mimetype="application/json")
+
+        response.vary.add("Accept-Encoding")
+        response.set_etag(etag, weak=True)  # same for gzip and identity encoding
+        response.cache_control.public = True
+        if version is None:
+            response.cache_control.max_age = MAX_AGE
+        else:
+            response.headers["Cache-Control"] = IMMUTABLE
+
+        return response.make_conditional(request)
+
+    app.view_functions["flasgger.apispec"] = apispec
+    app.add_url_rule("/apispec-<version>.json", view_func=apispec)
+
+
+if __name__ == "__main__":
+    print(build_apispec())
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
-import boto3
 import binascii
 
 from hashlib import md5
+from bson import ObjectId
 from flask import request
 from base64 import b64decode, b64encode
 from flask_mongoengine.documents import DynamicDocument
@@ -14,6 +14,8 @@ from filetype.types.archive import Gz
 from filetype.types.image import Jpeg, Png, Gif, Tiff
 
 from mpcontribs.api.contributions.document import get_resource, get_md5, COMPONENTS
+from mpcontribs.api.storage import get_storage
+from mpcontribs.api.metrics import timed
 
 MAX_BYTES = 2.4 * 1024 * 1024
 BUCKET = os.environ.get("S3_ATTACHMENTS_BUCKET", "mpcontribs-attachments")
@@ -21,7 +23,7 @@ S3_ATTACHMENTS_URL = f"https://{BUCKET}.s3.amazonaws.com"
 SUPPORTED_FILETYPES = (Gz, Jpeg, Png, Gif, Tiff)
 SUPPORTED_MIMES = [t().mime for t in SUPPORTED_FILETYPES]
 
-s3_client = boto3.client("s3")
+storage = get_storage(BUCKET)
 
 
 class Attachments(DynamicDocument):
@@ -46,12 +48,39 @@ class Attachments(DynamicDocument):
                     # document.reload("md5")  # TODO AttributeError: _changed_fields
                     raise ValueError("Please also request md5 field to retrieve attachment content!")
 
-                retr = s3_client.get_object(Bucket=BUCKET, Key=document.md5)
-                document.content = b64encode(retr["Body"].read()).decode("utf-8")
+                # fetch concurrently for all loaded documents, resolved in resolve_content
+                document._content_future = storage.submit(document.md5)
+
+    @timed("storage")
+    def resolve_content(self):
+        future = getattr(self, "_content_future", None)
+        if future is not None:
+            self.content = b64encode(future.result()).decode("utf-8")
+            self._content_future = None
+
+    @classmethod
+    def get_info(cls, aid):
+        """summary info as in client's `Attachment.info()` without downloading content"""
+        fields = {"name": 1, "md5": 1, "mime": 1, "content": 1}
+        doc = cls._get_collection().find_one({"_id": ObjectId(aid)}, fields)
+        if doc is None:
+            raise cls.DoesNotExist(f"Attachment {aid} not found")
+
+        info = {"id": str(aid), "name": doc["name"], "mime": doc["mime"], "md5": doc["md5"]}
+        # content set to size on save (see pre_save_post_validation)
+        content = doc.get("content", "")
+        info["size"] = int(content) if content.isdigit() else len(storage.get(doc["md5"]))
+        return info
 
     @classmethod
     def pre_delete(cls, sender, document, **kwargs):
-        s3_client.delete_object(Bucket=BUCKET, Key=document.md5)
+        storage.delete(document.md5)
+
+    @classmethod
+    def pre_bulk_delete(cls, ids):
+        # bulk deletes bypass signals, remove objects from storage in batches
+        docs = cls._get_collection().find({"_id": {"$in": list(ids)}}, {"md5": 1})
+        storage.delete_many(doc["md5"] for doc in docs if doc.get("md5"))
 
     @classmethod
     def pre_save_post_validation(cls, sender, document, **kwargs):
@@ -76,13 +105,12 @@ class Attachments(DynamicDocument):
         resource = get_resource("attachments")
         document.md5 = get_md5(resource, document, COMPONENTS["attachments"])
 
-        # save to S3 and unset content
-        s3_client.put_object(
-            Bucket=BUCKET,
-            Key=document.md5,
-            ContentType=document.mime,
-            Metadata={"name": document.name},
-            Body=content,
+        # save to storage and unset content
+        storage.put(
+            document.md5,
+            content,
+            content_type=document.mime,
+            metadata={"name": document.name},
         )
         document.content = str(size)  # set to something useful to distinguish in post_init
 
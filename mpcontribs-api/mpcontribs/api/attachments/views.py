@@ -4,11 +4,12 @@ import flask_mongorest
 from flask_mongorest.resources import Resource
 from flask_mongorest import operators as ops
 from flask_mongorest.methods import Fetch, BulkFetch, Download
-from flask import Blueprint
+from flask_mongorest.exceptions import UnknownFieldError
+from flask import Blueprint, request
 
 from mpcontribs.api import FILTERS
 from mpcontribs.api.core import SwaggerView
-from mpcontribs.api.attachments.document import Attachments
+from mpcontribs.api.attachments.document import Attachments, storage
 
 templates = os.path.join(os.path.dirname(flask_mongorest.__file__), "templates")
 attachments = Blueprint("attachments", __name__, template_folder=templates)
@@ -31,9 +32,31 @@ class AttachmentsResource(Resource):
 
     @staticmethod
     def get_optional_fields():
-        return ["content"]
+        return ["content", "content_url"]
+
+    def serialize(self, obj, **kwargs):
+        obj.resolve_content()  # wait for content fetched in post_init
+        return super().serialize(obj, **kwargs)
+
+    def value_for_field(self, obj, field):
+        if field == "content_url":
+            # presigned URL for direct download (null if unsupported by storage backend)
+            if not obj.md5:
+                raise ValueError("Please also request md5 field to retrieve content URL!")
+
+            return storage.url(obj.md5, filename=obj.name)
+        else:
+            raise UnknownFieldError
 
 
 class AttachmentsView(SwaggerView):
     resource = AttachmentsResource
     methods = [Fetch, BulkFetch, Download]
+
+    def get_validators(self, pk):
+        # presigned content URLs expire, don't let clients revalidate cached ones
+        requested_fields = self._resource.get_requested_fields(params=request.args)
+        if "content_url" in requested_fields:
+            return None
+
+        return super().get_validators(pk)
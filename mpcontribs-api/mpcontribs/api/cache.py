@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Redis-backed response cache for read-heavy GET endpoints"""
+import os
+import json
+
+from hashlib import md5
+from flask import current_app, request, jsonify, g
+from redis.exceptions import RedisError
+
+from mpcontribs.api import rq, get_logger, MPCONTRIBS_API_HOST
+
+CACHE_TTL = int(os.environ.get("API_CACHE_TTL", 600))  # seconds
+CACHE_PREFIX = f"cache_{MPCONTRIBS_API_HOST}"
+CACHE_HEADERS = ["Content-Type", "Content-Disposition", "ETag", "Last-Modified"]
+# endpoints to cache mapped to the collections their responses depend on
+CACHED_ENDPOINTS = {
+    "projectsFetch": ["projects"],
+    "projectsBulkFetch": ["projects"],
+    "projects.search": ["projects"],
+    "contributionsFetch": ["projects", "contributions"],
+    "contributionsBulkFetch": ["projects", "contributions"],
+    "contributions.search": ["projects", "contributions"],
+}
+
+logger = get_logger(__name__)
+
+
+def generation_key(collection):
+    return f"{CACHE_PREFIX}:generation:{collection}"
+
+
+def get_generations(*collections):
+    """current generations of collections to include in cache keys"""
+    generations = rq.connection.mget([generation_key(c) for c in collections])
+    return [int(gen or 0) for gen in generations]
+
+
+def invalidate(*collections):
+    """invalidate cached responses depending on collections by bumping their generation"""
+    try:
+        pipe = rq.connection.pipeline()
+        for collection in collections:
+            pipe.incr(generation_key(collection))
+        pipe.execute()
+    except (RedisError, RuntimeError) as ex:
+        logger.error(f"cache invalidation for {collections} failed: {ex}")
+
+
+def get_identity():
+    """normalized path, query and consumer (see SwaggerView.has_read_permission)"""
+    groups = request.headers.get("X-Authenticated-Groups", "").split(",")
+    groups += request.headers.get("X-Consumer-Groups", "").split(",")
+    return {
+        "path": request.path,
+        "query": sorted(request.args.items(multi=True)),
+        "accept": str(request.accept_mimetypes),
+        "groups": sorted(set(grp.strip() for grp in groups if grp)),
+        "username": request.headers.get("X-Consumer-Username"),
+        "anonymous": request.headers.get("X-Anonymous-Consumer"),
+        "external": request.headers.get("X-Forwarded-Host") is not None
+        and not request.headers.get("Origin"),
+    }
+
+
+def get_digest(identity):
+    return md5(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_cache_key():
+    """cache key for current request including generations of collections it depends on"""
+    identity = get_identity()
+    identity["generations"] = get_generations(*CACHED_ENDPOINTS[request.endpoint])
+    return f"{CACHE_PREFIX}:{request.endpoint}:{get_digest(identity)}"
+
+
+def get_etag(*validators):
+    """weak ETag for representation of documents with validators in current request"""
+    identity = get_identity()
+    identity["validators"] = [str(v) for v in validators]
+    return f'W/"{get_digest(identity)}"'
+
+
+def count(endpoint, result):
+    try:
+        rq.connection.hincrby(f"{CACHE_PREFIX}:stats", f"{endpoint}:{result}", 1)
+    except RedisError:
+        pass
+
+
+def get_cached_response():
+    """return cached response for current request if available"""
+    if request.method != "GET" or request.endpoint not in CACHED_ENDPOINTS:
+        return
+
+    try:
+        g.cache_key = get_cache_key()
+        if "no-cache" in request.headers.get("Cache-Control", ""):
+            return
+
+        entry = rq.connection.hgetall(g.cache_key)
+    except (RedisError, RuntimeError) as ex:
+        logger.warning(f"response cache unavailable: {ex}")
+        g.cache_key = None
+        return
+
+    if not entry:
+        return
+
+    count(request.endpoint, "hit")
+    headers = json.loads(entry[b"headers"])
+    response = current_app.response_class(entry[b"body"], headers=headers)
+    response.headers["X-Cache"] = "HIT"
+    return response
+
+
+def store_response(response):
+    """store successful response for cacheable request"""
+    cache_key = g.get("cache_key")
+    if not cache_key or response.headers.get("X-Cache") == "HIT":
+        return response
+
+    response.headers["X-Cache"] = "MISS"
+    count(request.endpoint, "miss")
+
+    if response.status_code != 200 or response.direct_passthrough:
+        return response
+
+    headers = {k: response.headers[k] for k in CACHE_HEADERS if k in response.headers}
+    try:
+        pipe = rq.connection.pipeline()
+        pipe.hset(
+            cache_key,
+            mapping={"body": response.get_data(), "headers": json.dumps(headers)},
+        )
+        pipe.expire(cache_key, CACHE_TTL)
+        pipe.execute()
+    except RedisError as ex:
+        logger.warning(f"failed to cache response: {ex}")
+
+    return response
+
+
+def conditional_response(response):
+    """add ETag to successful Fetch/BulkFetch responses and evaluate conditional requests"""
+    if (
+        request.method != "GET"
+        or not request.endpoint
+        or not request.endpoint.endswith("Fetch")
+        or response.status_code != 200
+        or response.direct_passthrough
+    ):
+        return response
+
+    response.add_etag()  # keeps ETag set by view
+    return response.make_conditional(request)
+
+
+def stats():
+    """hit/miss counts of response cache per endpoint"""
+    try:
+        counts = rq.connection.hgetall(f"{CACHE_PREFIX}:stats")
+    except RedisError as ex:
+        return jsonify({"error": str(ex)}), 503
+
+    ret = {endpoint: {"hit": 0, "miss": 0} for endpoint in CACHED_ENDPOINTS}
+    for field, value in counts.items():
+        endpoint, result = field.decode("utf-8").rsplit(":", 1)
+        ret.setdefault(endpoint, {})[result] = int(value)
+
+    return jsonify(ret)
+
+
+def init_cache(app):
+    """register response cache hooks after Compress to store uncompressed responses"""
+    # NOTE after_request hooks run in reverse order: store, add ETag, compress
+    app.before_request(get_cached_response)
+    app.after_request(conditional_response)
+    app.after_request(store_response)
+    app.add_url_rule("/cache/stats", view_func=stats)
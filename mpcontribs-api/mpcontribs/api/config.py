@@ -2,21 +2,16 @@
 """configuration module for MPContribs Flask API"""
 
 import os
-import json
-import gzip
 
 from mpcontribs.api import __version__
+from mpcontribs.api.contributions.formulae import load_formulae
 
-formulae_path = os.path.join(
-    os.path.dirname(__file__), "contributions", "formulae.json.gz"
-)
-
-with gzip.open(formulae_path) as f:
-    FORMULAE = json.load(f)
+FORMULAE = load_formulae()  # memory-mapped, shared across workers if index built
 
 VERSION = __version__
 
 JSON_ADD_STATUS = False
+JSON_PROVIDER = os.environ.get("JSON_PROVIDER", "orjson")  # or "default"
 SECRET_KEY = "super-secret"  # TODO in local prod config
 
 MAIL_DEFAULT_SENDER = os.environ.get("MAIL_DEFAULT_SENDER")
@@ -30,9 +25,19 @@ MONGODB_SETTINGS = {
     "db": MPCONTRIBS_DB,
     "compressors": ["snappy", "zstd", "zlib"],
 }
+if MPCONTRIBS_MONGO_HOST == "mongomock":  # local profiling, see scripts/profile_api.py
+    import mongomock
+
+    MONGODB_SETTINGS = {
+        "host": f"mongodb://localhost/{MPCONTRIBS_DB}",
+        "db": MPCONTRIBS_DB,
+        "mongo_client_class": mongomock.MongoClient,
+    }
 REDIS_ADDRESS = os.environ.get("REDIS_ADDRESS", "redis")
 REDIS_URL = RQ_REDIS_URL = RQ_DASHBOARD_REDIS_URL = f"redis://{REDIS_ADDRESS}"
 DOC_DIR = os.path.join(os.path.dirname(__file__), f"swagger-{MPCONTRIBS_DB}")
+# precomputed and gzipped at build time, see apispec.py
+APISPEC_PATH = os.path.join(os.path.dirname(__file__), f"apispec-{VERSION}.json.gz")
 
 SWAGGER = {
     "swagger_ui_bundle_js": "//unpkg.com/swagger-ui-dist@3/swagger-ui-bundle.js",
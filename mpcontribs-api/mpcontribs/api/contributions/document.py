@@ -4,9 +4,8 @@ import itertools
 
 from hashlib import md5
 from math import isnan
-from bson.dbref import DBRef
 from datetime import datetime
-from flask import current_app
+from flask import current_app, g, has_request_context
 from atlasq import AtlasManager, AtlasQ
 from itertools import permutations
 from importlib import import_module
@@ -24,6 +23,7 @@ from uncertainties import ufloat_fromstr
 from pymatgen.core import Composition, Element
 
 from mpcontribs.api import enter, valid_dict, delimiter
+from mpcontribs.api.cache import invalidate
 
 quantity_keys = {"display", "value", "error", "unit"}
 max_dgts = 6
@@ -312,18 +312,81 @@ class Contributions(DynamicDocument):
         document.last_modified = datetime.utcnow()
         document.needs_build = True
 
+    @classmethod
+    def get_orphaned_components(cls, ids):
+        """components only referenced by contributions with ids (one aggregation per component)"""
+        coll = cls._get_collection()
+        projection = {component: 1 for component in COMPONENTS.keys()}
+        refs = {component: set() for component in COMPONENTS.keys()}
+
+        for doc in coll.find({"_id": {"$in": ids}}, projection):
+            for component in COMPONENTS.keys():
+                refs[component].update(doc.get(component, []))
+
+        orphans = {}
+
+        for component, cids in refs.items():
+            if not cids:
+                continue
+
+            # components still referenced by other contributions
+            cids = list(cids)
+            pipeline = [
+                {"$match": {component: {"$in": cids}, "_id": {"$nin": ids}}},
+                {"$project": {component: 1}},
+                {"$unwind": f"${component}"},
+                {"$match": {component: {"$in": cids}}},
+                {"$group": {"_id": f"${component}"}},
+            ]
+            shared = {doc["_id"] for doc in coll.aggregate(pipeline)}
+            orphans[component] = [cid for cid in cids if cid not in shared]
+
+        return orphans
+
+    @classmethod
+    def delete_components(cls, orphans):
+        for component, cids in orphans.items():
+            if not cids:
+                continue
+
+            document = get_resource(component).document
+            if hasattr(document, "pre_bulk_delete"):
+                document.pre_bulk_delete(cids)
+
+            document._get_collection().delete_many({"_id": {"$in": cids}})
+
+    @classmethod
+    def bulk_delete(cls, ids):
+        """delete contributions and their orphaned components in batch"""
+        ids = list(ids)
+        orphans = cls.get_orphaned_components(ids)
+        count = cls._get_collection().delete_many({"_id": {"$in": ids}}).deleted_count
+        cls.delete_components(orphans)
+        invalidate("contributions")
+        return count
+
     @classmethod
     def pre_delete(cls, sender, document, **kwargs):
-        args = list(COMPONENTS.keys())
-        document.reload(*args)
+        # delete components not referenced by other contributions
+        orphans = cls.get_orphaned_components([document.id])
+        cls.delete_components(orphans)
+
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        invalidate("contributions")
+        if document.needs_build:
+            if has_request_context():
+                # queued once per request in notebooks.views.queue_request_rebuilds
+                g.setdefault("rebuild_ids", set()).add(document.id)
+            else:
+                # NOTE notebooks.views imports this module
+                from mpcontribs.api.notebooks.views import queue_rebuilds
+
+                queue_rebuilds([document.id])
 
-        for component in COMPONENTS.keys():
-            # check if other contributions exist before deletion
-            # and make sure component still exists (getattr converts ref to object)
-            for obj in getattr(document, component):
-                q = {component: obj.id}
-                if sender.objects(**q).count() < 2 and not isinstance(obj, DBRef):
-                    obj.delete()
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        invalidate("contributions")
 
 
 signals.post_init.connect(Contributions.post_init, sender=Contributions)
@@ -331,3 +394,5 @@ signals.pre_save_post_validation.connect(
     Contributions.pre_save_post_validation, sender=Contributions
 )
 signals.pre_delete.connect(Contributions.pre_delete, sender=Contributions)
+signals.post_save.connect(Contributions.post_save, sender=Contributions)
+signals.post_delete.connect(Contributions.post_delete, sender=Contributions)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped identifier -> formula lookup shared across worker processes
+
+The index is built from formulae.json.gz (see generate_formulae.py) during the
+docker build via `python -m mpcontribs.api.contributions.formulae`. Layout (native
+byte order, uint32 arrays):
+
+    header        magic, number of keys, number of unique formulae
+    key_offsets   nkeys + 1 offsets into key blob (keys sorted as utf-8 bytes)
+    val_index     nkeys indices into unique formulae
+    val_offsets   nvals + 1 offsets into value blob
+    key blob, value blob
+"""
+import os
+import sys
+import gzip
+import json
+import mmap
+import struct
+
+from array import array
+from collections.abc import Mapping
+
+MAGIC = b"MPCF"
+HEADER = struct.Struct("=4sII")
+SRC_PATH = os.path.join(os.path.dirname(__file__), "formulae.json.gz")
+INDEX_PATH = os.path.join(os.path.dirname(__file__), "formulae.idx")
+
+
+def build_index(src=SRC_PATH, dst=INDEX_PATH):
+    """convert formulae.json.gz into memory-mappable index"""
+    with gzip.open(src) as f:
+        formulae = json.load(f)
+
+    items = sorted((k.encode("utf-8"), v) for k, v in formulae.items())
+    values = sorted(set(formulae.values()))
+    lookup = {v: i for i, v in enumerate(values)}
+    values = [v.encode("utf-8") for v in values]
+
+    def offsets(blobs):
+        ret, pos = array("I", [0]), 0
+        for blob in blobs:
+            pos += len(blob)
+            ret.append(pos)
+        return ret
+
+    keys = [k for k, _ in items]
+    tmp = f"{dst}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(keys), len(values)))
+        offsets(keys).tofile(f)
+        array("I", [lookup[v] for _, v in items]).tofile(f)
+        offsets(values).tofile(f)
+        f.write(b"".join(keys))
+        f.write(b"".join(values))
+
+    os.replace(tmp, dst)
+    return dst
+
+
+class FormulaeIndex(Mapping):
+    """read-only mapping backed by mmap'ed index (pages shared via page cache)"""
+
+    def __init__(self, path=INDEX_PATH):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.nkeys, nvals = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a formulae index")
+
+        buf, pos = memoryview(self.mm), HEADER.size
+
+        def uint32(n):
+            nonlocal pos
+            start, pos = pos, pos + 4 * n
+            return buf[start:pos].cast("I")
+
+        self.key_offsets = uint32(self.nkeys + 1)
+        self.val_index = uint32(self.nkeys)
+        self.val_offsets = uint32(nvals + 1)
+        self.keys_start = pos
+        self.vals_start = pos + self.key_offsets[-1]
+
+    def _key(self, i):
+        start = self.keys_start + self.key_offsets[i]
+        return self.mm[start : self.keys_start + self.key_offsets[i + 1]]
+
+    def _value(self, i):
+        j = self.val_index[i]
+        start = self.vals_start + self.val_offsets[j]
+        end = self.vals_start + self.val_offsets[j + 1]
+        return self.mm[start:end].decode("utf-8")
+
+    def _find(self, key):
+        key = key.encode("utf-8")
+        lo, hi = 0, self.nkeys
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo if lo < self.nkeys and self._key(lo) == key else -1
+
+    def __getitem__(self, key):
+        i = self._find(key) if isinstance(key, str) else -1
+        if i < 0:
+            raise KeyError(key)
+
+        return self._value(i)
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self._find(key) >= 0
+
+    def __iter__(self):
+        return (self._key(i).decode("utf-8") for i in range(self.nkeys))
+
+    def __len__(self):
+        return self.nkeys
+
+
+def load_formulae(src=SRC_PATH, index=INDEX_PATH):
+    """memory-mapped index if built and up-to-date, otherwise dict from source"""
+    if os.path.exists(index) and (
+        not os.path.exists(src) or os.path.getmtime(index) >= os.path.getmtime(src)
+    ):
+        return FormulaeIndex(index)
+
+    with gzip.open(src) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    print(build_index(*sys.argv[1:]))
@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 import re
 import os
+import gzip
 import flask_mongorest
 
+from bson import ObjectId
+from datetime import datetime
 from itertools import permutations
 from css_html_js_minify import html_minify
 from json2html import Json2Html
 from boltons.iterutils import remap
 from werkzeug.exceptions import Unauthorized
+from pymatgen.core import Structure
 from pymatgen.core.composition import Composition, CompositionError
+from redis.exceptions import RedisError
 
-from flask import Blueprint, render_template, jsonify, abort, request
+from flask import Blueprint, render_template, jsonify, abort, request, current_app
 from flask_mongorest.resources import Resource
 from flask_mongorest import operators as ops
 from flask_mongorest.methods import (
@@ -24,20 +29,34 @@ from flask_mongorest.methods import (
     Download,
 )
 from flask_mongorest.exceptions import UnknownFieldError
+from mongoengine.queryset.visitor import Q
 
-from mpcontribs.api import enter, FILTERS
+from mpcontribs.api import enter, FILTERS, rq, get_logger, MPCONTRIBS_API_HOST
+from mpcontribs.api.cache import get_generations, invalidate
 from mpcontribs.api.core import SwaggerView
-from mpcontribs.api.contributions.document import Contributions
+from mpcontribs.api.contributions.document import Contributions, COMPONENTS, grouper
+from mpcontribs.api.projects.document import Projects
 from mpcontribs.api.structures.views import StructuresResource
 from mpcontribs.api.tables.views import TablesResource
 from mpcontribs.api.attachments.views import AttachmentsResource
-from mpcontribs.api.notebooks.views import NotebooksResource
+from mpcontribs.api.notebooks.views import NotebooksResource, queue_rebuilds
+from mpcontribs.api.notebooks.render import table_frame
+from mpcontribs.api.structures.document import Structures
+from mpcontribs.api.tables.document import Tables
+from mpcontribs.api.attachments.document import Attachments, storage
 
 templates = os.path.join(os.path.dirname(flask_mongorest.__file__), "templates")
 contributions = Blueprint("contributions", __name__, template_folder=templates)
 exclude = r'[^$.\s_~`^&(){}[\]\\;\'"/]'
 j2h = Json2Html()
 MAX_UNAPPROVED_CONTRIBS = 500
+DELETE_BATCH_SIZE = 1000
+# fields that BulkUpdate can set without per-document save (no quantity parsing)
+FAST_UPDATE_FIELDS = {"is_public", "needs_build"}
+CARD_FORMATS = ["bootstrap", "bulma"]
+CARD_PREFIX = f"cards_{MPCONTRIBS_API_HOST}"
+CARD_TTL = int(os.environ.get("CARD_CACHE_TTL", 7 * 24 * 3600))  # seconds
+logger = get_logger(__name__)
 
 
 def visit(path, key, value):
@@ -46,6 +65,92 @@ def visit(path, key, value):
     return True
 
 
+def card_key(obj, fmt, generation):
+    # projects generation accounts for changes in project title/description/authors/references
+    last_modified = obj.last_modified.isoformat() if obj.last_modified else ""
+    return f"{CARD_PREFIX}:{obj.id}:{last_modified}:{fmt}:{generation}"
+
+
+def render_card(obj, project, fmt):
+    """render card for contribution with data loaded"""
+    ctx = {
+        "cid": str(obj.id),
+        "title": project.title,
+        "references": project.references[:5],
+        "landing_page": f"/projects/{project.id}/",
+        "more": f"/contributions/{obj.id}",
+    }
+    ctx["descriptions"] = project.description.strip().split(".", 1)
+    authors = [a.strip() for a in project.authors.split(",") if a]
+    ctx["authors"] = {"main": authors[0], "etal": authors[1:]}
+    ctx["data"] = j2h.convert(
+        json=remap(obj.data, visit=visit, enter=enter),
+        table_attributes='class="table is-narrow is-fullwidth has-background-light"',
+    )
+    return html_minify(render_template(f"card_{fmt}.html", **ctx))
+
+
+def get_cards(objs, fmts):
+    """get cards for contributions from store and render missing cards in batch"""
+    cards, keys = {}, {}
+
+    try:
+        generation = get_generations("projects")[0]
+        keys = {
+            (str(obj.id), fmt): card_key(obj, fmt, generation)
+            for obj in objs
+            for fmt in fmts
+        }
+        for k, card in zip(keys.keys(), rq.connection.mget(keys.values())):
+            if card is not None:
+                cards[k] = card.decode("utf-8")
+    except RedisError as ex:
+        logger.warning(f"card store unavailable: {ex}")
+        keys = {}
+
+    missing = {
+        str(obj.id)
+        for obj in objs
+        if any((str(obj.id), fmt) not in cards for fmt in fmts)
+    }
+
+    if not missing:
+        return cards
+
+    # load data and project info once for all missing cards
+    # NOTE exclude/only due to custom queryset managers
+    docs = Contributions.objects.only("id", "project", "data").filter(
+        id__in=list(missing)
+    )
+    docs = [doc for doc in docs]
+    exclude = list(Projects._fields.keys())
+    only = ["name", "title", "references", "description", "authors"]
+    names = list({doc.project.pk for doc in docs})
+    projects = Projects.objects.exclude(*exclude).only(*only).filter(name__in=names)
+    projects = {project.id: project for project in projects}
+    rendered = {}
+
+    for doc in docs:
+        cid = str(doc.id)
+        project = projects[doc.project.pk]
+        for fmt in fmts:
+            if (cid, fmt) not in cards:
+                rendered[(cid, fmt)] = render_card(doc, project, fmt)
+
+    cards.update(rendered)
+
+    if keys and rendered:
+        try:
+            pipe = rq.connection.pipeline()
+            for k, card in rendered.items():
+                pipe.set(keys[k], card, ex=CARD_TTL)
+            pipe.execute()
+        except RedisError as ex:
+            logger.warning(f"failed to store cards: {ex}")
+
+    return cards
+
+
 class ContributionsResource(Resource):
     document = Contributions
     related_resources = {
@@ -104,37 +209,30 @@ class ContributionsResource(Resource):
             "card_bulma",
         ]
 
+    def fetch_related_resources(self, objs, only_fields=None):
+        super().fetch_related_resources(objs, only_fields=only_fields)
+        # retrieve/render requested cards for all objects at once
+        fmts = [
+            field.rsplit("_", 1)[1]
+            for field in only_fields or []
+            if field.startswith("card_") and field.rsplit("_", 1)[1] in CARD_FORMATS
+        ]
+        self._cards = get_cards(objs, fmts) if objs and fmts else {}
+
     def value_for_field(self, obj, field):
         if field.startswith("card_"):
             _, fmt = field.rsplit("_", 1)
-            if fmt not in ["bootstrap", "bulma"]:
+            if fmt not in CARD_FORMATS:
                 raise UnknownFieldError
 
-            if obj.project is None or not obj.data:
-                # try data reload to account for custom queryset manager
-                obj.reload("id", "project", "data")
-
-            # obj.project is LazyReference & Projects uses custom queryset manager
-            DocType = obj.project.document_type
-            exclude = list(DocType._fields.keys())
-            only = ["title", "references", "description", "authors"]
-            pk = obj.project.pk
-            project = DocType.objects.exclude(*exclude).only(*only).with_id(pk)
-            ctx = {
-                "cid": str(obj.id),
-                "title": project.title,
-                "references": project.references[:5],
-                "landing_page": f"/projects/{project.id}/",
-                "more": f"/contributions/{obj.id}",
-            }
-            ctx["descriptions"] = project.description.strip().split(".", 1)
-            authors = [a.strip() for a in project.authors.split(",") if a]
-            ctx["authors"] = {"main": authors[0], "etal": authors[1:]}
-            ctx["data"] = j2h.convert(
-                json=remap(obj.data, visit=visit, enter=enter),
-                table_attributes='class="table is-narrow is-fullwidth has-background-light"',
-            )
-            return html_minify(render_template(f"card_{fmt}.html", **ctx))
+            if not hasattr(self, "_cards"):
+                self._cards = {}
+
+            key = (str(obj.id), fmt)
+            if key not in self._cards:
+                self._cards.update(get_cards([obj], [fmt]))
+
+            return self._cards[key]
         else:
             raise UnknownFieldError
 
@@ -170,6 +268,49 @@ class ContributionsView(SwaggerView):
 
         return True
 
+    def check_permissions(self, objs, has_permission):
+        """check permission once per project (project is LazyReferenceField)"""
+        permissions = {}
+
+        for obj in objs:
+            name = obj.project.pk
+            if name not in permissions:
+                permissions[name] = has_permission(request, obj)
+
+            if not permissions[name]:
+                raise Unauthorized
+
+    def process_objects(self, objs):
+        # fast path: set simple fields for all contributions with a single update_many
+        data = self._resource.raw_data
+        if not data or not set(data.keys()) <= FAST_UPDATE_FIELDS:
+            return super().process_objects(objs)
+
+        update = {}
+        for key, value in data.items():
+            Contributions._fields[key].validate(value)
+            update[f"set__{key}"] = value
+
+        self.check_permissions(objs, self.has_change_permission)
+        update["set__last_modified"] = datetime.utcnow()
+        ids = [obj.id for obj in objs]
+        count = Contributions.objects(id__in=ids).update(**update) if ids else 0
+        invalidate("contributions")
+        if count and data.get("needs_build"):
+            queue_rebuilds(ids)
+
+        return {"count": count}
+
+    def delete_objects(self, objs):
+        """delete contributions and their orphaned components in batches"""
+        count = 0
+
+        for batch in grouper(DELETE_BATCH_SIZE, objs):
+            self.check_permissions(batch, self.has_delete_permission)
+            count += Contributions.bulk_delete(obj.id for obj in batch)
+
+        return {"count": count}
+
 
 @contributions.route("/search")
 def search():
@@ -225,3 +366,77 @@ def search():
         )
 
     return jsonify(results)
+
+
+def component_info(name, oid):
+    """summary info for component as in client's `info()` methods"""
+    if name == "structures":
+        fields = ["name", "md5", "lattice", "sites", "charge"]
+        obj = Structures.objects.only(*fields).get(id=oid)
+        structure = Structure.from_dict(obj.to_mongo().to_dict())
+        return {
+            "id": oid,
+            "name": obj.name,
+            "md5": obj.md5,
+            "formula": structure.composition.formula,
+            "reduced_formula": structure.composition.reduced_formula,
+            "nsites": len(structure),
+        }
+    elif name == "tables":
+        obj = Tables.objects.get(id=oid)
+        info = obj.attrs.to_mongo().to_dict() if obj.attrs else {}
+        info.update(id=oid, name=obj.name, md5=obj.md5)
+        info["columns"] = ", ".join(obj.columns)
+        info["nrows"] = obj.total_data_rows
+        return info
+
+    return Attachments.get_info(oid)
+
+
+def component_file(name, oid):
+    """content, mime type and filename to download component"""
+    if name == "structures":
+        obj = Structures.objects.only("name", "cif").get(id=oid)
+        content = gzip.compress(obj.cif.encode("utf-8"))
+        return content, "application/gzip", f"{oid}_{obj.name}.cif.gz"
+    elif name == "tables":
+        obj = Tables.objects.only("index", "columns", "data").get(id=oid)
+        df, _ = table_frame(obj)
+        content = gzip.compress(df.to_csv().encode("utf-8"))
+        return content, "application/gzip", f"{oid}_{obj.name}.csv.gz"
+
+    obj = Attachments.objects.get(id=oid)
+    return storage.get(obj.md5), obj.mime, f"{oid}_{obj.name}"
+
+
+@contributions.route("/component/<oid>")
+def component(oid):
+    """resolve ObjectId of a readable component to its type and summary info
+
+    Use `?download=1` to retrieve the component as file (gzipped CIF or CSV for
+    structures and tables, attachment content as stored).
+    """
+    if not ObjectId.is_valid(oid):
+        abort(400, description=f"Invalid ObjectId {oid}.")
+
+    query = Q()
+    for name in COMPONENTS:
+        query |= Q(**{name: oid})
+
+    # NOTE exclude/only due to custom queryset manager
+    qs = Contributions.objects(query).exclude(*Contributions._fields).only(*COMPONENTS)
+    contrib = ContributionsView().has_read_permission(request, qs).first()
+    if contrib is None:
+        abort(404, description=f"Component with ObjectId {oid} not found.")
+
+    name = next(
+        name for name in COMPONENTS
+        if any(str(ref.id) == oid for ref in getattr(contrib, name))
+    )
+
+    if request.args.get("download", type=int):
+        content, mime, filename = component_file(name, oid)
+        headers = {"Content-Disposition": f"attachment; filename={filename}"}
+        return current_app.response_class(content, mimetype=mime, headers=headers)
+
+    return jsonify({"component": name, "info": component_info(name, oid)})
@@ -6,6 +6,7 @@ import logging
 import yaml
 
 from copy import deepcopy
+from datetime import datetime
 from re import Pattern
 from importlib import import_module
 from flasgger.marshmallow_apispec import SwaggerView as OriginalSwaggerView
@@ -14,9 +15,14 @@ from marshmallow_mongoengine import ModelSchema
 from flask_mongorest.views import ResourceView
 from mongoengine.queryset import DoesNotExist
 from mongoengine.queryset.visitor import Q
+from flask import request
+from redis.exceptions import RedisError
 from werkzeug.exceptions import Unauthorized
-from mpcontribs.api.config import DOC_DIR
+from werkzeug.http import http_date, is_resource_modified
+from mpcontribs.api.config import DOC_DIR, APISPEC_PATH
 from mpcontribs.api import is_gunicorn, get_logger
+from mpcontribs.api.cache import get_etag, get_generations
+from mpcontribs.api.metrics import timed
 
 logger = get_logger(__name__)
 
@@ -436,24 +442,86 @@ class SwaggerView(OriginalSwaggerView, ResourceView):
                         )
                     },
                 )
-                cls.definitions = {cls.schema_name: schema2jsonschema(cls.Schema)}
                 cls.resource.schema = cls.Schema
 
-                # write flask-mongorest swagger specs
-                for method in cls.methods:
-                    spec = get_specs(cls, method, cls.tags[0])
-                    if spec:
-                        dir_path = os.path.join(DOC_DIR, cls.tags[0])
-                        file_path = os.path.join(dir_path, method.__name__ + ".yml")
-                        if not os.path.exists(file_path):
-                            os.makedirs(dir_path, exist_ok=True)
-
-                        if is_gunicorn:
-                            with open(file_path, "w") as f:
-                                yaml.dump(spec, f)
-                                logger.debug(
-                                    f"{cls.tags[0]}.{method.__name__} written to {file_path}"
-                                )
+                # skip spec generation if precomputed at build time (see apispec.py)
+                if not os.path.exists(APISPEC_PATH):
+                    cls.generate_specs(write=is_gunicorn)
+
+    @classmethod
+    def generate_specs(cls, write=True):
+        """generate definitions and write flask-mongorest swagger specs"""
+        cls.definitions = {cls.schema_name: schema2jsonschema(cls.Schema)}
+        if not write:
+            return
+
+        for method in cls.methods:
+            spec = get_specs(cls, method, cls.tags[0])
+            if spec:
+                dir_path = os.path.join(DOC_DIR, cls.tags[0])
+                file_path = os.path.join(dir_path, method.__name__ + ".yml")
+                os.makedirs(dir_path, exist_ok=True)
+
+                with open(file_path, "w") as f:
+                    yaml.dump(spec, f)
+                    logger.debug(f"{cls.tags[0]}.{method.__name__} written to {file_path}")
+
+    def get(self, **kwargs):
+        # NOTE no docstring to keep flasgger from overriding specs for GET
+        pk = kwargs.get("pk")
+        validators = self.get_validators(pk) if pk else None
+        if not validators:
+            return super().get(**kwargs)
+
+        headers = {"ETag": get_etag(pk, *validators)}
+        # NOTE notebook rebuilds and project changes only validated via ETag
+        # (takes precedence over Last-Modified if clients send both)
+        if isinstance(validators[0], datetime):
+            headers["Last-Modified"] = http_date(validators[0])
+
+        if not is_resource_modified(
+            request.environ,
+            etag=headers["ETag"],
+            last_modified=headers.get("Last-Modified"),
+        ):
+            return {}, "304 Not Modified", headers
+
+        return super().get(**kwargs), "200 OK", headers
+
+    def get_validators(self, pk):
+        """last_modified and notebook of contribution or content md5 of component
+
+        Used to validate Fetch (ETag/Last-Modified). Cards also depend on the projects
+        generation (title, authors, references, see contributions.views.card_key).
+        """
+        document = self.resource.document
+        generations = []
+
+        if "last_modified" in document._fields:
+            fields = ["last_modified"]
+            if "notebook" in document._fields:
+                fields.append("notebook")  # set on (re)build without last_modified
+            requested_fields = self._resource.get_requested_fields(params=request.args)
+            if any(field.startswith("card_") for field in requested_fields):
+                try:
+                    generations = get_generations("projects")
+                except RedisError:
+                    return None
+            # NOTE exclude/only due to custom queryset manager
+            qs = document.objects.exclude(*document._fields).only(*fields)
+            qs = self.has_read_permission(request, qs)
+        elif "md5" in document._fields:
+            # md5 digests are immutable for ObjectIds, no read permission needed for 304
+            fields = ["md5"]
+            qs = document.objects.only(*fields)
+        else:
+            return None
+
+        obj = qs.filter(pk=pk).first()
+        if obj is None or getattr(obj, fields[0], None) is None:
+            return None
+
+        return [getattr(obj, field, None) for field in fields] + generations
 
     def get_groups(self, request):
         groups = request.headers.get("X-Authenticated-Groups", "").split(",")
@@ -533,6 +601,7 @@ class SwaggerView(OriginalSwaggerView, ResourceView):
 
         return qfilter
 
+    @timed("permission")
     def has_read_permission(self, request, qs):
         if self.is_admin(request):
             return qs  # admins can read all entries
@@ -598,12 +667,16 @@ class SwaggerView(OriginalSwaggerView, ResourceView):
                 from mpcontribs.api.contributions.document import get_resource
 
                 resource = get_resource(component)
-                qfilter = lambda qs: qs.clone()
+                # only IDs needed here, avoid loading/formatting paginated fields (table rows)
+                resource.fields_to_paginate = {}
+                id_only = resource.document.objects.only("id")
 
                 if pk:
-                    ids = [resource.get_object(pk, qfilter=qfilter).id]
+                    ids = [id_only.get(pk=pk).id]
                 else:
-                    ids = [o.id for o in resource.get_objects(qfilter=qfilter)[0]]
+                    qfilter = lambda qs: qs.clone()
+                    objs = resource.get_objects(qs=id_only, qfilter=qfilter)[0]
+                    ids = [o.id for o in objs]
 
                 if not ids:
                     return qs.none()
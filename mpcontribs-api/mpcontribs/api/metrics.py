@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Per-request phase timings as Server-Timing headers and Prometheus metrics
+
+Phases (wall time, outermost call only if nested; phases can overlap, e.g. Mongo
+queries in signal handlers):
+    permission  read permission filter (SwaggerView.has_read_permission)
+    mongo       database commands (pymongo command monitoring or mongomock)
+    serialize   flask-mongorest resource serialization
+    storage     object storage (S3/local) calls waited on by the request
+    signals     mongoengine signal handlers
+
+Set PROMETHEUS_MULTIPROC_DIR to aggregate metrics across gunicorn workers.
+"""
+import os
+import time
+
+from inspect import isfunction
+from contextlib import contextmanager
+from flask import current_app, request, g, has_request_context
+from pymongo import monitoring
+from prometheus_client import Histogram, CollectorRegistry, REGISTRY
+from prometheus_client import generate_latest, multiprocess, CONTENT_TYPE_LATEST
+
+PHASES = ["permission", "mongo", "serialize", "storage", "signals"]
+REQUEST_SECONDS = Histogram(
+    "mpcontribs_api_request_seconds",
+    "request duration per endpoint",
+    ["endpoint", "method", "status"],
+)
+PHASE_SECONDS = Histogram(
+    "mpcontribs_api_phase_seconds",
+    "time spent per request phase and endpoint",
+    ["endpoint", "phase"],
+)
+
+
+def record(phase, seconds):
+    if has_request_context():
+        timings = g.setdefault("timings", {})
+        timings[phase] = timings.get(phase, 0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    """add wall time of block/function to phase of current request"""
+    if not has_request_context():
+        yield
+        return
+
+    active = g.setdefault("active_phases", set())
+    if phase in active:
+        yield  # already timed by outer call
+        return
+
+    active.add(phase)
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        active.discard(phase)
+        record(phase, time.perf_counter() - tic)
+
+
+class MongoTimer(monitoring.CommandListener):
+    """record duration of database commands issued by current request"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record("mongo", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record("mongo", event.duration_micros / 1e6)
+
+
+def instrument():
+    """time third-party code paths that can't be decorated in place"""
+    from mongoengine import signals
+    from flask_mongorest.resources import Resource
+
+    if getattr(Resource.serialize, "instrumented", False):
+        return
+
+    Resource.serialize = timed("serialize")(Resource.serialize)
+    Resource.serialize.instrumented = True
+
+    for name in signals.__all__:
+        signal = getattr(signals, name)
+        if hasattr(signal, "send"):
+            signal.send = timed("signals")(signal.send)
+
+    monitoring.register(MongoTimer())
+
+    try:
+        from mongomock.collection import Collection, Cursor
+    except ImportError:
+        return
+
+    # mongomock doesn't support command monitoring
+    methods = [m for m, f in vars(Collection).items() if isfunction(f) and m[0] != "_"]
+    for klass, names in [(Collection, methods), (Cursor, ["__next__", "distinct"])]:
+        for name in names:
+            setattr(klass, name, timed("mongo")(getattr(klass, name)))
+
+
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+def add_timings(response):
+    """add Server-Timing header and observe Prometheus metrics"""
+    start = g.get("request_start")
+    if start is None:
+        return response
+
+    total = time.perf_counter() - start
+    timings = g.get("timings", {})
+    endpoint = request.endpoint or "unknown"
+    REQUEST_SECONDS.labels(endpoint, request.method, response.status_code).observe(
+        total
+    )
+
+    entries = []
+    for phase in PHASES:
+        if phase in timings:
+            PHASE_SECONDS.labels(endpoint, phase).observe(timings[phase])
+            entries.append(f"{phase};dur={timings[phase] * 1000:.1f}")
+
+    entries.append(f"total;dur={total * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(entries)
+    return response
+
+
+def metrics():
+    """Prometheus metrics (aggregated across workers in multiprocess mode)"""
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    body = generate_latest(registry)
+    return current_app.response_class(body, mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app):
+    """instrument request phases - call before MongoEngine to monitor its client"""
+    instrument()
+    app.before_request(start_timer)
+    app.after_request(add_timings)
+    app.add_url_rule("/metrics", view_func=metrics)
@@ -1,65 +1,128 @@
 # -*- coding: utf-8 -*-
+import os
+import time
+
 from uuid import uuid1
-from flask import current_app
+from threading import Lock
 from tornado.escape import json_encode, json_decode
+from websocket import WebSocketException, WebSocketTimeoutException
 from mpcontribs.api import create_kernel_connection, get_logger
 
 logger = get_logger(__name__)
+CELL_TIMEOUT = float(os.environ.get("CELL_TIMEOUT", 60))  # seconds per code cell
+OUTPUT_TYPES = {"stream", "display_data", "execute_result"}
+# long-lived channels per kernel, used by one worker at a time (see `acquire_kernels`)
+connections = {}
+connections_lock = Lock()
+
+
+def get_connection(kernel_id):
+    with connections_lock:
+        ws = connections.get(kernel_id)
+
+        if ws is None or not ws.connected:
+            ws = create_kernel_connection(kernel_id)
+            connections[kernel_id] = ws
+
+        return ws
+
+
+def close_connection(kernel_id):
+    """close channels to kernel, e.g. before restart or after failure"""
+    with connections_lock:
+        ws = connections.pop(kernel_id, None)
+
+    if ws is not None:
+        ws.close()
+
 
+def execute_request(cid, idx, cell):
+    return {
+        "header": {
+            "username": cid,
+            "version": "5.3",
+            "session": "",
+            "msg_id": f"{cid}-{idx}-{uuid1()}",
+            "msg_type": "execute_request",
+        },
+        "parent_header": {},
+        "channel": "shell",
+        "content": {
+            "code": cell["source"],
+            "silent": False,
+            "store_history": False,
+            "user_expressions": {},
+            "allow_stdin": False,
+            "stop_on_error": True,
+        },
+        "metadata": {},
+        "buffers": [],
+    }
 
-def run_cells(kernel_id, cid, cells):
+
+def send_cells(kernel_id, cid, cells):
+    """submit all code cells at once (kernel executes them in order)"""
+    messages = [
+        execute_request(cid, idx, cell)
+        for idx, cell in enumerate(cells)
+        if cell["cell_type"] == "code"
+    ]
+
+    for retry in [True, False]:
+        ws = get_connection(kernel_id)
+        try:
+            for msg in messages:
+                ws.send(json_encode(msg))
+            return ws, [msg["header"]["msg_id"] for msg in messages]
+        except (WebSocketException, OSError):
+            close_connection(kernel_id)  # stale pooled connection
+            if not retry:
+                raise
+
+
+def run_cells(kernel_id, cid, cells, timeout=CELL_TIMEOUT):
+    """execute code cells pipelined on kernel and collect outputs per cell index
+
+    Output messages are routed to cells by the parent `msg_id` which encodes the cell
+    index. Messages for other requests (e.g. left over from an aborted build) are
+    skipped. Each cell has `timeout` seconds to finish after the previous one.
+    """
     logger.debug(f"running {cid} on {kernel_id}")
-    ws = create_kernel_connection(kernel_id)
-    outputs = {}
-
-    for idx, cell in enumerate(cells):
-        if cell["cell_type"] == "code":
-            ws.send(
-                json_encode(
-                    {
-                        "header": {
-                            "username": cid,
-                            "version": "5.3",
-                            "session": "",
-                            "msg_id": f"{cid}-{idx}-{uuid1()}",
-                            "msg_type": "execute_request",
-                        },
-                        "parent_header": {},
-                        "channel": "shell",
-                        "content": {
-                            "code": cell["source"],
-                            "silent": False,
-                            "store_history": False,
-                            "user_expressions": {},
-                            "allow_stdin": False,
-                            "stop_on_error": True,
-                        },
-                        "metadata": {},
-                        "buffers": [],
-                    }
-                )
-            )
-
-            outputs[idx] = []
-            status = None
-            while status is None or status == "busy" or not len(outputs[idx]):
-                msg = ws.recv()
-                msg = json_decode(msg)
-                msg_type = msg["msg_type"]
-                if msg_type == "status":
-                    status = msg["content"]["execution_state"]
-                elif msg_type in ["stream", "display_data", "execute_result"]:
-                    # display_data/execute_result required fields:
-                    #   "output_type", "data", "metadata"
-                    # stream required fields: "output_type", "name", "text"
-                    output = msg["content"]
-                    output.pop("transient", None)
-                    output["output_type"] = msg_type
-                    msg_idx = msg["parent_header"]["msg_id"].split("-")[1]
-                    outputs[int(msg_idx)].append(output)
-                elif msg_type == "error":
-                    tb = msg["content"]["traceback"]
-                    raise ValueError(tb)
-
-    ws.close()
+    ws, msg_ids = send_cells(kernel_id, cid, cells)
+    pending = {msg_id: int(msg_id.split("-")[1]) for msg_id in msg_ids}
+    outputs = {idx: [] for idx in pending.values()}
+    deadline = time.perf_counter() + timeout
+
+    try:
+        while pending:
+            ws.settimeout(max(deadline - time.perf_counter(), 0.001))
+            msg = json_decode(ws.recv())
+            msg_id = msg["parent_header"].get("msg_id")
+            if msg_id not in pending:
+                continue
+
+            msg_type = msg["msg_type"]
+            if msg_type == "status":
+                if msg["content"]["execution_state"] == "idle":
+                    pending.pop(msg_id)
+                    deadline = time.perf_counter() + timeout  # next cell starts
+            elif msg_type in OUTPUT_TYPES:
+                # display_data/execute_result required fields:
+                #   "output_type", "data", "metadata"
+                # stream required fields: "output_type", "name", "text"
+                output = msg["content"]
+                output.pop("transient", None)
+                output["output_type"] = msg_type
+                outputs[pending[msg_id]].append(output)
+            elif msg_type == "error":
+                tb = msg["content"]["traceback"]
+                raise ValueError(tb)
+    except WebSocketTimeoutException:
+        close_connection(kernel_id)  # replies for pending cells would still arrive
+        idx = min(pending.values())
+        raise TimeoutError(f"cell {idx} of {cid} timed out after {timeout}s")
+    except (WebSocketException, OSError):
+        close_connection(kernel_id)
+        raise
+
     return outputs
@@ -1,18 +1,18 @@
 # -*- coding: utf-8 -*-
 import os
-import boto3
 import hashlib
 
-from io import BytesIO
 from mongoengine import signals
 from base64 import b64decode, b64encode
 from flask_mongoengine.documents import Document
 from mongoengine.fields import DictField, StringField, IntField, ListField
 from mongoengine.queryset.manager import queryset_manager
 
+from mpcontribs.api.storage import get_storage
+
 BUCKET = os.environ.get("S3_IMAGES_BUCKET", "mpcontribs-images")
 S3_DOWNLOAD_URL = f"https://{BUCKET}.s3.amazonaws.com"
-s3_client = boto3.client("s3")
+storage = get_storage(BUCKET)
 
 
 class Kernelspec(DictField):
@@ -84,6 +84,8 @@ class Notebooks(Document):
             old_key = self.escaped_key
             new_key = self.problem_key
 
+        images = []
+
         for cell in self.cells:
             for output in cell.get("outputs", []):
                 data = output.get("data", {})
@@ -94,19 +96,16 @@ class Notebooks(Document):
                     if incoming:
                         contents = data.pop("image/png")  # base64 encoded
                         key = hashlib.sha1(contents.encode("utf-8")).hexdigest()
-                        s3_client.put_object(
-                            Bucket=BUCKET,
-                            Key=key,
-                            ContentType="image/png",
-                            Body=b64decode(contents),
-                        )
+                        storage.put(key, b64decode(contents), content_type="image/png")
                         data["image/png"] = key
                     elif len(data["image/png"]) == 40:
-                        key = data.pop("image/png")
-                        # TODO catch key doesn't exist
-                        retr = s3_client.get_object(Bucket=BUCKET, Key=key)
-                        gzip_buffer = BytesIO(retr["Body"].read())
-                        data["image/png"] = b64encode(gzip_buffer.getvalue()).decode()
+                        images.append(data)
+
+        if images:
+            # TODO catch key doesn't exist
+            contents = storage.get_many(data["image/png"] for data in images)
+            for data in images:
+                data["image/png"] = b64encode(contents[data["image/png"]]).decode()
 
     def clean(self):
         self.transform()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Render notebook outputs for contributions in-process from stored documents
+
+Produces the outputs of the code cells in `views.get_cells` as the kernel would
+(with the client's `Dict.display`, `Table.display`, `Structure.display` and
+`Attachment.info`) without the round trip through a kernel calling back into the
+API. Notebook builds fall back to the kernel if rendering fails.
+"""
+import json
+import pandas as pd
+import plotly.io as pio
+
+from inspect import getfullargspec
+from boltons.iterutils import remap
+from flask import current_app, request
+from IPython.lib.pretty import pretty
+from plotly.express import line
+from pymatgen.core import Structure
+
+from mpcontribs.api.contributions.document import Contributions
+from mpcontribs.api.tables.document import Tables
+from mpcontribs.api.structures.document import Structures
+from mpcontribs.api.structures.views import StructuresResource
+from mpcontribs.api.attachments.document import Attachments
+
+PLOTLY_RENDERERS = ["plotly_mimetype", "notebook"]  # default in jupyter kernels
+PLOTLY_TEMPLATE = "simple_white"  # set by client
+LINE_KWARGS = set(getfullargspec(line).args)
+
+
+def jsonable(dct):
+    """round-trip through app's JSON provider (as received by client)"""
+    return json.loads(current_app.json.dumps(dct))
+
+
+def display_data(html):
+    text = "<IPython.core.display.HTML object>"
+    data = {"text/html": html, "text/plain": text}
+    return {"output_type": "display_data", "data": data, "metadata": {}}
+
+
+def execute_result(data):
+    return {
+        "output_type": "execute_result",
+        "data": data,
+        "metadata": {},
+        "execution_count": None,
+    }
+
+
+def render_contribution(document):
+    """`client.get_contribution(cid).display()`"""
+    # NOTE contributions.views imports notebooks.views
+    from mpcontribs.api.contributions.views import ContributionsResource, j2h, visit
+
+    # NOTE exclude/only due to custom queryset manager
+    fields = [f for f in Contributions._fields if f != "needs_build"]  # internal field
+    qs = Contributions.objects(id=document.id).exclude(*Contributions._fields)
+    obj = qs.only(*fields).get()
+    # serialize as for `GET /contributions/<cid>/?_fields=...` from client
+    query_string = {"_fields": ",".join(fields)}
+    with current_app.test_request_context(query_string=query_string):
+        res = ContributionsResource()
+        res.fetch_related_resources([obj], res.get_requested_fields(params=request.args))
+        contrib = res.serialize(obj, params=request.args)
+    html = j2h.convert(
+        json=remap(jsonable(contrib), visit=visit),
+        table_attributes='class="table is-narrow is-fullwidth has-background-light"',
+    )
+    return display_data(html)
+
+
+def table_frame(table):
+    """DataFrame for table as in client's `Table.from_dict` (numeric where possible)"""
+    attrs = table.attrs.to_mongo().to_dict() if table.attrs else {}
+    df = pd.DataFrame.from_records(table.data, columns=table.columns, index=table.index)
+    for col in df.columns:
+        try:
+            df[col] = df[col].apply(pd.to_numeric)
+        except Exception:
+            continue
+    try:
+        df.index = pd.to_numeric(df.index)
+    except Exception:
+        pass
+
+    labels = attrs.get("labels", {})
+    if "index" in labels:
+        df.index.name = labels["index"]
+    if "variable" in labels:
+        df.columns.name = labels["variable"]
+
+    return df, attrs
+
+
+def render_table(tid):
+    """`client.get_table(tid).display()` as plotly line chart"""
+    table = Tables.objects.only("index", "columns", "data").get(id=tid)
+    df, attrs = table_frame(table)
+    attrs.update(id=str(table.id), name=table.name, md5=table.md5)
+    kwargs = {k: v for k, v in attrs.items() if k in LINE_KWARGS}
+    fig = line(df, template=PLOTLY_TEMPLATE, **kwargs)
+    data = {"text/plain": pretty(fig)}
+    for renderer in PLOTLY_RENDERERS:
+        data.update(pio.renderers[renderer].to_mimebundle(fig.to_dict()))
+
+    return execute_result(data)
+
+
+def render_structure(sid):
+    """`client.get_structure(sid).display()` as structure summary"""
+    fields = ["lattice", "sites", "charge"]
+    structure = Structures.objects.only(*fields).get(id=sid)
+    dct = StructuresResource().serialize(structure, fields=fields)
+    return execute_result({"text/plain": pretty(Structure.from_dict(jsonable(dct)))})
+
+
+def render_attachment(aid):
+    """`client.get_attachment(aid).info()`"""
+    return execute_result({"text/plain": pretty(Attachments.get_info(aid))})
+
+
+def render_outputs(document):
+    """outputs per code cell index for cells built by `views.get_cells`"""
+    outputs = {1: [render_contribution(document)]}
+    idx = 2
+    components = [
+        (document.tables, render_table),
+        (document.structures, render_structure),
+        (document.attachments, render_attachment),
+    ]
+
+    for objs, render in components:
+        if objs:
+            idx += 1  # markdown header
+            for obj in objs:
+                outputs[idx] = [render(obj.id)]
+                idx += 1
+
+    return outputs
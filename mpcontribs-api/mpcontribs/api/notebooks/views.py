@@ -1,26 +1,34 @@
 # -*- coding: utf-8 -*-
 import os
+import json
 import time
 import requests
 import flask_mongorest
 
+from bson import ObjectId
+from datetime import datetime
+from queue import SimpleQueue, Empty
+from threading import Condition, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
 from rq import get_current_job
-from rq.job import Job
-from gevent import sleep
+from rq.job import Job, JobStatus
+from redis.exceptions import ConnectionError as RedisConnectionError
 from nbformat import v4 as nbf
-from flask_rq2 import RQ
-from flask import Blueprint, request, abort, jsonify, current_app
+from flask import Blueprint, request, abort, jsonify, current_app, g
 from flask_mongorest import operators as ops
 from flask_mongorest.methods import Fetch, BulkFetch
 from flask_mongorest.resources import Resource
 from mongoengine.errors import DoesNotExist
 from mongoengine.queryset.visitor import Q
 
-from mpcontribs.api import get_kernel_endpoint, get_logger
+from mpcontribs.api import get_kernel_endpoint, get_logger, is_admin, rq
+from mpcontribs.api.cache import invalidate
 from mpcontribs.api.core import SwaggerView
 from mpcontribs.api.contributions.document import Contributions
+from mpcontribs.api.projects.document import get_stats_job, STATS_JOB_TTL
 from mpcontribs.api.notebooks.document import Notebooks
-from mpcontribs.api.notebooks import run_cells
+from mpcontribs.api.notebooks import run_cells, close_connection
+from mpcontribs.api.notebooks.render import render_outputs
 
 
 logger = get_logger(__name__)
@@ -29,10 +37,17 @@ notebooks = Blueprint("notebooks", __name__, template_folder=templates)
 
 MPCONTRIBS_API_HOST = os.environ.get("MPCONTRIBS_API_HOST", "default")
 ADMIN_GROUP = os.environ.get("ADMIN_GROUP", "admin")
-
-rq = RQ()
-rq.default_queue = f"notebooks_{MPCONTRIBS_API_HOST}"
-rq.queues = [rq.default_queue]
+# render outputs in-process ("inprocess") or always execute cells in kernels ("kernel")
+NOTEBOOK_RENDERER = os.environ.get("NOTEBOOK_RENDERER", "inprocess")
+KERNEL_MAX_MEMORY = float(os.environ.get("KERNEL_MAX_MEMORY", 1024))  # MB
+REBUILD_DELAY = float(os.environ.get("REBUILD_DELAY", 30))  # seconds after last save
+REBUILD_BATCH = int(os.environ.get("REBUILD_BATCH", 100))  # contributions per batch
+REBUILD_KEY = f"{rq.default_queue}:rebuild"  # sorted set of cids by due time
+REBUILD_POLL = 1  # seconds between checks of rebuild queue while waiting
+# hashes of kernel id -> owner and status (memory, latency, restarts) across processes
+KERNEL_OWNERS_KEY = f"{rq.default_queue}:kernels:owners"
+KERNEL_STATS_KEY = f"{rq.default_queue}:kernels:stats"
+kernels_available = Condition()
 
 
 class NotebooksResource(Resource):
@@ -53,31 +68,55 @@ class NotebooksView(SwaggerView):
     methods = [Fetch, BulkFetch]
 
 
-def execute_cells(cid, cells):
-    ntries = 0
-    while ntries < 5:
-        for kernel_id, running_cid in current_app.kernels.items():
-            if running_cid is None:
-                current_app.kernels[kernel_id] = cid
-                try:
-                    outputs = run_cells(kernel_id, cid, cells)
-                except:
-                    current_app.kernels[kernel_id] = None
-                    raise
+def acquire_kernels(owner, n=None, timeout=25):
+    """reserve up to n free kernels, waiting for at least one to become available"""
+    kernels = getattr(current_app, "kernels", None) or {}
+    with kernels_available:
+        if not kernels_available.wait_for(
+            lambda: None in kernels.values(), timeout=timeout
+        ):
+            return []
+
+        kernel_ids = [k for k, v in kernels.items() if v is None][:n]
+        for kernel_id in kernel_ids:
+            kernels[kernel_id] = owner
+
+        set_kernel_owners(kernel_ids, owner)
+        return kernel_ids
+
+
+def release_kernels(kernel_ids):
+    with kernels_available:
+        for kernel_id in kernel_ids:
+            current_app.kernels[kernel_id] = None
+
+        set_kernel_owners(kernel_ids, None)
+        kernels_available.notify_all()
+
+
+def set_kernel_owners(kernel_ids, owner):
+    """share kernel owners with other processes (for `/notebooks/kernels`)"""
+    if not kernel_ids:
+        return
+
+    try:
+        if owner is None:
+            rq.connection.hdel(KERNEL_OWNERS_KEY, *kernel_ids)
+        else:
+            owners = dict.fromkeys(kernel_ids, owner)
+            rq.connection.hset(KERNEL_OWNERS_KEY, mapping=owners)
+    except RedisConnectionError:
+        logger.warning("RQ not available, kernel owners not shared")
 
-                current_app.kernels[kernel_id] = None
-                return outputs
-            else:
-                logger.warning(f"{kernel_id} busy with {running_cid}")
 
-        logger.warning("WAITING for a kernel to become available")
-        sleep(5)
-        ntries += 1
+def get_kernel_stats(kernel_id):
+    stats = rq.connection.hget(KERNEL_STATS_KEY, kernel_id)
+    return json.loads(stats) if stats else {"restarts": 0}
 
 
 @notebooks.route("/build")
 def build():
-    if not getattr(current_app, "kernels", None):
+    if NOTEBOOK_RENDERER != "inprocess" and not getattr(current_app, "kernels", None):
         abort(404, description="No kernels available.")
 
     cids = request.args.get("cids")
@@ -90,32 +129,104 @@ def build():
 
     if cids:
         kwargs["cids"] = cids.split(",")
+        invalid = [cid for cid in kwargs["cids"] if not ObjectId.is_valid(cid)]
+        if invalid:
+            abort(400, description=f"Invalid contribution ObjectId(s): {invalid}")
+
+    if cids and not projects:
+        # e.g. on page view: prioritize in rebuild queue instead of blocking
+        job_id = queue_rebuilds(kwargs["cids"], viewed=True)
+        if not job_id:
+            abort(503, description="Rebuild queue not available.")
 
-    if len(kwargs.get("cids", [])) == 1:
-        return jsonify(make(**kwargs))
+        return job_id
 
     job = make.queue(**kwargs)
     return job.id
 
 
-def restart_kernels():
-    """use to avoid run-away memory"""
-    kernel_ids = [k for k, v in current_app.kernels.items() if v is None]
+def get_kernel_status(kernel_id):
+    """memory usage (MB) and round-trip latency (ms) of kernel"""
+    cells = [nbf.new_code_cell("\n".join([
+        "import psutil",
+        "print(psutil.Process().memory_info().rss)"
+    ]))]
+    tic = time.perf_counter()
+    outputs = run_cells(kernel_id, "kernel_status", cells, timeout=10)
+    latency = (time.perf_counter() - tic) * 1000
+    rss = int(outputs[0][0]["text"])
+    return {"memory": round(rss / 1024**2, 1), "latency": round(latency, 1)}
 
-    for kernel_id in kernel_ids:
-        kernel_url = get_kernel_endpoint(kernel_id) + "/restart"
-        requests.post(kernel_url, json={})
-        cells = [nbf.new_code_cell("\n".join([
-            "from mpcontribs.client import Client",
-            "print('client imported')"
-        ]))]
-        run_cells(kernel_id, "import_client", cells)
+
+def warm_kernel(kernel_id):
+    """import client and load API specs into (restarted) kernel"""
+    cells = [nbf.new_code_cell("from mpcontribs.client import Client"), client_cell()]
+    run_cells(kernel_id, "warm_kernel", cells)
+
+
+@rq.job()
+def recycle_kernels(force=False):
+    """restart idle kernels above KERNEL_MAX_MEMORY (avoid run-away memory)
+
+    Runs in the build worker (kernels reserved per process), queue as job elsewhere.
+    """
+    kernel_ids = acquire_kernels("recycle", timeout=0)
+
+    try:
+        for kernel_id in kernel_ids:
+            stats = get_kernel_stats(kernel_id)
+            try:
+                stats.update(get_kernel_status(kernel_id), error=None)
+            except Exception as e:
+                stats["error"] = str(e)
+
+            stats["checked"] = datetime.utcnow().isoformat()
+            if force or stats["error"] or stats["memory"] >= KERNEL_MAX_MEMORY:
+                close_connection(kernel_id)
+                kernel_url = get_kernel_endpoint(kernel_id) + "/restart"
+                requests.post(kernel_url, json={}, timeout=30)
+                stats["restarts"] += 1
+                try:
+                    warm_kernel(kernel_id)
+                    stats.update(get_kernel_status(kernel_id), error=None)
+                except Exception as e:
+                    stats["error"] = str(e)
+
+            rq.connection.hset(KERNEL_STATS_KEY, kernel_id, json.dumps(stats))
+    finally:
+        release_kernels(kernel_ids)
+
+
+@notebooks.route("/kernels")
+def kernel_pool():
+    """kernel pool health (admins only), `?recycle=1` to check/recycle idle kernels
+
+    Recycling is queued in the build worker, status and owners are shared via redis.
+    """
+    if not is_admin():
+        abort(403, description="kernel pool only available to admins")
+
+    ret = {}
+    if request.args.get("recycle", type=int):
+        force = bool(request.args.get("force", type=int))
+        ret["job"] = recycle_kernels.queue(force=force, at_front=True).id
+
+    pool = getattr(current_app, "kernels", None) or {}
+    owners = rq.connection.hgetall(KERNEL_OWNERS_KEY)
+    ret["kernels"] = {
+        kernel_id: dict(
+            get_kernel_stats(kernel_id),
+            owner=(owners.get(kernel_id.encode()) or b"").decode() or None
+        )
+        for kernel_id in pool
+    }
+    return jsonify(ret)
 
 
 @notebooks.route('/result', defaults={'job_id': None})
 @notebooks.route("/result/<job_id>")
 def result(job_id):
-    if not current_app.kernels:
+    if NOTEBOOK_RENDERER != "inprocess" and not getattr(current_app, "kernels", None):
         abort(404, description="No kernels available.")
 
     if not job_id:
@@ -135,11 +246,202 @@ def result(job_id):
     return jsonify(job.result)
 
 
+def client_cell():
+    # define client only once in kernel
+    # avoids API calls for regex expansion for query parameters
+    return nbf.new_code_cell("\n".join([
+        "if 'client' not in locals():",
+        "\tclient = Client(",
+        f'\t\theaders={{"X-Authenticated-Groups": "{ADMIN_GROUP}"}},',
+        f'\t\thost="{MPCONTRIBS_API_HOST}"',
+        "\t)",
+        "print(client.get_totals())",
+    ]))
+
+
+def get_cells(document):
+    """cells to build notebook for contribution (first cell sets up client in kernel)"""
+    cells = [
+        client_cell(),
+        nbf.new_code_cell("\n".join([
+            f'c = client.get_contribution("{document.id}")',
+            'c.display()'
+        ])),
+    ]
+
+    if document.tables:
+        cells.append(nbf.new_markdown_cell("## Tables"))
+        for table in document.tables:
+            cells.append(
+                nbf.new_code_cell("\n".join([
+                    f't = client.get_table("{table.id}")',
+                    't.display()'
+                ]))
+            )
+
+    if document.structures:
+        cells.append(nbf.new_markdown_cell("## Structures"))
+        for structure in document.structures:
+            cells.append(
+                nbf.new_code_cell("\n".join([
+                    f's = client.get_structure("{structure.id}")',
+                    's.display()'
+                ]))
+            )
+
+    if document.attachments:
+        cells.append(nbf.new_markdown_cell("## Attachments"))
+        for attachment in document.attachments:
+            cells.append(
+                nbf.new_code_cell("\n".join([
+                    f'a = client.get_attachment("{attachment.id}")',
+                    'a.info()'
+                ]))
+            )
+
+    return cells
+
+
+def build_notebook(kernel_id, document):
+    """render (or run cells on kernel) and save notebook, return error if any"""
+    if document.notebook:
+        try:
+            nb = Notebooks.objects.get(id=document.notebook.id)
+            nb.delete()
+            document.update(unset__notebook="")
+            invalidate("contributions")
+            logger.debug(f"Notebook {document.notebook.id} deleted.")
+        except DoesNotExist:
+            pass
+
+    cid = str(document.id)
+    logger.debug(f"prep notebook for {cid} ...")
+    document.reload("tables", "structures", "attachments")
+    cells = get_cells(document)
+    outputs = None
+
+    if NOTEBOOK_RENDERER == "inprocess":
+        try:
+            outputs = render_outputs(document)
+        except Exception as e:
+            logger.warning(f"rendering {cid} failed, falling back to kernel: {e}")
+
+    if outputs is None:
+        if kernel_id is None:
+            return {"status": "ERROR: NO KERNELS", "cid": cid}
+
+        try:
+            outputs = run_cells(kernel_id, cid, cells)
+        except Exception as e:
+            return {"status": "ERROR", "cid": cid, "exc": str(e)}
+
+    if not outputs:
+        return {"status": "ERROR: NO OUTPUTS", "cid": cid}
+
+    for idx, output in outputs.items():
+        cells[idx]["outputs"] = output
+
+    doc = nbf.new_notebook()
+    doc["cells"] = [
+        nbf.new_code_cell("from mpcontribs.client import Client"),
+        nbf.new_code_cell(f'client = Client()'),
+    ]
+    doc["cells"] += cells[1:]  # skip localhost Client
+
+    try:
+        nb = Notebooks(**doc).save()
+        document.update(notebook=nb, needs_build=False)
+        invalidate("contributions")
+    except Exception as e:
+        return {"status": "ERROR", "cid": cid, "exc": str(e)}
+
+
+def build_notebooks(
+    documents, force=False, owner="make", deadline=None, recycle=True, built=None
+):
+    """build notebooks for documents concurrently on all available kernels
+
+    Each kernel pulls the next contribution off a shared queue. The first error or
+    the deadline stops all kernels after their current contribution. Ids of built
+    (or up-to-date) contributions are added to the `built` set if provided.
+    """
+    job = get_current_job()
+    todo = SimpleQueue()
+    for document in documents:
+        todo.put(document)
+
+    total = todo.qsize()
+    if NOTEBOOK_RENDERER == "inprocess":
+        # kernels only needed as fallback, don't wait for them
+        kernel_ids = acquire_kernels(owner, timeout=0) if total else []
+    else:
+        kernel_ids = acquire_kernels(owner) if total else []
+        if total and not kernel_ids:
+            return {"status": "ERROR: NO KERNELS", "count": 0, "total": total}
+
+    app = current_app._get_current_object()
+    progress = {"count": 0, "total": total, "kernels": len(kernel_ids)}
+    workers = kernel_ids or [None]
+    result, lock, stop = {}, Lock(), Event()
+
+    def report(status=None):
+        # NOTE called with lock held
+        if status and not result:
+            result.update(status)
+            stop.set()
+
+        if job:
+            job.meta["progress"] = progress
+            job.save_meta()
+
+    def work(kernel_id):
+        with app.app_context():
+            while not stop.is_set():
+                if deadline and time.perf_counter() > deadline:
+                    with lock:
+                        report({"status": "TIMEOUT"})
+                    return
+
+                try:
+                    document = todo.get_nowait()
+                except Empty:
+                    return
+
+                if not force and document.notebook and \
+                        not getattr(document, "needs_build", True):
+                    if built is not None:
+                        built.add(str(document.id))
+                    continue
+
+                error = build_notebook(kernel_id, document)
+                with lock:
+                    if not error:
+                        progress["count"] += 1
+                        if built is not None:
+                            built.add(str(document.id))
+                    report(error)
+
+    with lock:
+        report()
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            list(executor.map(work, workers))
+    finally:
+        release_kernels(kernel_ids)
+
+    if recycle and job and kernel_ids and (result or total):
+        recycle_kernels()
+
+    result = result or {"status": "COMPLETED"}
+    result.update(count=progress["count"], total=total)
+    return result
+
+
 @rq.job()
 def make(projects=None, cids=None, force=False):
     """build the notebook / details page"""
-    start = time.perf_counter()
-    remaining_time = rq.default_timeout - 5
+    deadline = time.perf_counter() + rq.default_timeout - 5
     mask = ["id", "needs_build", "notebook"]
     query = Q()
 
@@ -161,133 +463,153 @@ def make(projects=None, cids=None, force=False):
 
     exclude = list(Contributions._fields.keys())
     documents = Contributions.objects(query).exclude(*exclude).only(*mask)
-    total = documents.count()
-    count = 0
+    owner = job.id if job else "make"
+    ret["result"] = build_notebooks(documents, force=force, owner=owner, deadline=deadline)
+    return ret
 
-    for idx, document in enumerate(documents):
-        stop = time.perf_counter()
-        remaining_time -= stop - start
 
-        if remaining_time < 0:
-            if job:
-                restart_kernels()
+def queue_rebuilds(cids, viewed=False):
+    """add contributions to rebuild queue and make sure a rebuild job is pending
 
-            ret["result"] = {"status": "TIMEOUT", "count": count, "total": total}
-            return ret
+    Saved contributions are due REBUILD_DELAY seconds after their last save (debounce).
+    Viewed contributions are due immediately, most recently viewed first.
+    """
+    now = time.time()
+    if viewed:
+        scores, option = {str(cid): -now for cid in cids}, {"lt": True}
+    else:
+        scores, option = {str(cid): now + REBUILD_DELAY for cid in cids}, {"gt": True}
 
-        start = time.perf_counter()
+    try:
+        if scores:
+            rq.connection.zadd(REBUILD_KEY, scores, **option)
 
-        if not force and document.notebook and \
-                not getattr(document, "needs_build", True):
-            continue
+        return ensure_rebuild_job(at_front=viewed)
+    except RedisConnectionError:
+        logger.warning("RQ not available, rebuilds left to `make` (needs_build)")
+        return None
 
-        if document.notebook:
-            try:
-                nb = Notebooks.objects.get(id=document.notebook.id)
-                nb.delete()
-                document.update(unset__notebook="")
-                logger.debug(f"Notebook {document.notebook.id} deleted.")
-            except DoesNotExist:
-                pass
-
-        cid = str(document.id)
-        logger.debug(f"prep notebook for {cid} ...")
-        document.reload("tables", "structures", "attachments")
-
-        cells = [
-            # define client only once in kernel
-            # avoids API calls for regex expansion for query parameters
-            nbf.new_code_cell("\n".join([
-                "if 'client' not in locals():",
-                "\tclient = Client(",
-                f'\t\theaders={{"X-Authenticated-Groups": "{ADMIN_GROUP}"}},',
-                f'\t\thost="{MPCONTRIBS_API_HOST}"',
-                "\t)",
-                "print(client.get_totals())",
-                # return something. See while loop in `run_cells`
-            ])),
-            nbf.new_code_cell("\n".join([
-                f'c = client.get_contribution("{document.id}")',
-                'c.display()'
-            ])),
-        ]
-
-        if document.tables:
-            cells.append(nbf.new_markdown_cell("## Tables"))
-            for table in document.tables:
-                cells.append(
-                    nbf.new_code_cell("\n".join([
-                        f't = client.get_table("{table.id}")',
-                        't.display()'
-                    ]))
-                )
 
-        if document.structures:
-            cells.append(nbf.new_markdown_cell("## Structures"))
-            for structure in document.structures:
-                cells.append(
-                    nbf.new_code_cell("\n".join([
-                        f's = client.get_structure("{structure.id}")',
-                        's.display()'
-                    ]))
-                )
+@notebooks.teardown_app_request
+def queue_request_rebuilds(exc):
+    """queue rebuilds for contributions saved during request (see Contributions.post_save)"""
+    cids = g.pop("rebuild_ids", None)
+    if cids:
+        queue_rebuilds(cids)
 
-        if document.attachments:
-            cells.append(nbf.new_markdown_cell("## Attachments"))
-            for attachment in document.attachments:
-                cells.append(
-                    nbf.new_code_cell("\n".join([
-                        f'a = client.get_attachment("{attachment.id}")',
-                        'a.info()'
-                    ]))
-                )
 
-        try:
-            outputs = execute_cells(cid, cells)
-        except Exception as e:
-            if job:
-                restart_kernels()
+def ensure_rebuild_job(at_front=False):
+    """queue rebuild job unless one is pending already and return its id"""
+    job = get_stats_job("job", key=REBUILD_KEY)
+    status = job.get_status() if job else None
+    pending = {JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED}
 
-            ret["result"] = {
-                "status": "ERROR", "cid": cid, "count": count, "total": total, "exc": str(e)
-            }
-            return ret
+    if status in pending:
+        return job.id
 
-        if not outputs:
-            if job:
-                restart_kernels()
+    # started job might have seen the queue empty already
+    depends_on = job if status == JobStatus.STARTED else None
+    job = rebuild.queue(depends_on=depends_on, at_front=at_front)
+    rq.connection.set(f"{REBUILD_KEY}:job", job.id, ex=STATS_JOB_TTL)
+    return job.id
 
-            ret["result"] = {
-                "status": "ERROR: NO OUTPUTS", "cid": cid, "count": count, "total": total
-            }
-            return ret
 
-        for idx, output in outputs.items():
-            cells[idx]["outputs"] = output
+def next_rebuild():
+    """seconds until first contribution in rebuild queue is due (None if empty)"""
+    first = rq.connection.zrange(REBUILD_KEY, 0, 0, withscores=True)
+    return max(first[0][1] - time.time(), 0) if first else None
 
-        doc = nbf.new_notebook()
-        doc["cells"] = [
-            nbf.new_code_cell("from mpcontribs.client import Client"),
-            nbf.new_code_cell(f'client = Client()'),
-        ]
-        doc["cells"] += cells[1:]  # skip localhost Client
+
+def pop_rebuilds(n=REBUILD_BATCH):
+    """pop up to n due contributions off rebuild queue, with their scores"""
+    now = time.time()
+    items = rq.connection.zpopmin(REBUILD_KEY, n)
+    later = {cid: score for cid, score in items if score > now}
+
+    if later:
+        rq.connection.zadd(REBUILD_KEY, later, nx=True)  # keep newer saves
+
+    return {cid.decode(): score for cid, score in items if score <= now}
+
+
+def requeue_rebuilds(scores):
+    """put popped contributions back into rebuild queue unless saved/viewed since"""
+    if scores:
+        rq.connection.zadd(REBUILD_KEY, scores, nx=True)
+
+
+@rq.job()
+def rebuild():
+    """build notebooks for contributions in rebuild queue in batches per project
+
+    Waits for contributions not due yet (debounce) and exits once the queue is empty.
+    """
+    deadline = time.perf_counter() + rq.default_timeout - 5
+    job = get_current_job()
+    owner = job.id if job else "rebuild"
+    mask = ["id", "project", "needs_build", "notebook"]
+    exclude = list(Contributions._fields.keys())
+    ret = {"count": 0, "total": 0, "errors": []}
+
+    while time.perf_counter() < deadline:
+        wait = next_rebuild()
+        if wait is None:
+            break
+        elif wait > 0:
+            # wake up regularly for viewed contributions (due immediately)
+            wait = min(wait, REBUILD_POLL, deadline - time.perf_counter())
+            time.sleep(max(wait, 0))
+            continue
+
+        popped = pop_rebuilds()
+        cids = [cid for cid in popped if ObjectId.is_valid(cid)]
+        if len(cids) < len(popped):
+            invalid = [cid for cid in popped if not ObjectId.is_valid(cid)]
+            logger.warning(f"invalid ids dropped from rebuild queue: {invalid}")
+
+        if not cids:
+            continue
+
+        # ids not built are put back (failed ones debounced to avoid hot loop)
+        pending, built, failed = set(cids), set(), set()
 
         try:
-            nb = Notebooks(**doc).save()
-            document.update(notebook=nb, needs_build=False)
+            # batch per project in order of priority (first due)
+            documents = Contributions.objects(id__in=cids).exclude(*exclude).only(*mask)
+            priority = {cid: idx for idx, cid in enumerate(cids)}
+            batches = {}
+            for document in sorted(documents, key=lambda d: priority[str(d.id)]):
+                batches.setdefault(document.project.pk, []).append(document)
+
+            pending = {str(d.id) for batch in batches.values() for d in batch}
+
+            for name, batch in batches.items():
+                # contributions requested explicitly, build even if notebook exists
+                result = build_notebooks(
+                    batch, force=True, owner=owner, deadline=deadline, recycle=False,
+                    built=built
+                )
+                ret["count"] += result.pop("count")
+                ret["total"] += result.pop("total")
+                if result["status"] != "COMPLETED":
+                    logger.error(f"rebuild for {name} failed: {result}")
+                    ret["errors"].append(dict(result, project=name))
+                    if "cid" in result:
+                        failed.add(result["cid"])
         except Exception as e:
-            if job:
-                restart_kernels()
+            logger.error(f"rebuild of {len(cids)} contributions failed: {e}")
+            ret["errors"].append({"status": "ERROR", "exc": str(e)})
+            failed = pending - built
 
-            ret["result"] = {
-                "status": "ERROR", "cid": cid, "count": count, "total": total, "exc": str(e)
-            }
-            return ret
+        due = time.time() + REBUILD_DELAY
+        requeue_rebuilds({
+            cid: due if cid in failed else popped[cid] for cid in pending - built
+        })
 
-        count += 1
+    if job and ret["total"] and getattr(current_app, "kernels", None):
+        recycle_kernels()
 
-    if total and job:
-        restart_kernels()
+    if rq.connection.zcard(REBUILD_KEY):
+        ensure_rebuild_job()  # continue in new job after timeout
 
-    ret["result"] = {"status": "COMPLETED", "count": count, "total": total}
     return ret
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import urllib
 
 from math import isnan
@@ -7,6 +8,9 @@ from flatten_dict import flatten
 from boltons.iterutils import remap
 from collections import ChainMap
 from flask import current_app, render_template, url_for, request
+from redis.exceptions import ConnectionError as RedisConnectionError
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
 from mongoengine import Document
 from marshmallow import ValidationError
 from marshmallow.fields import String
@@ -24,13 +28,21 @@ from mongoengine.fields import (
     DecimalField,
     FloatField,
     IntField,
+    ListField,
     EmbeddedDocumentListField,
     EmbeddedDocumentField,
 )
 from mpcontribs.api import send_email, valid_key, valid_dict, delimiter, enter
+from mpcontribs.api import rq, get_logger, STATS_QUEUE
+from mpcontribs.api.cache import invalidate
 
 PROVIDERS = {"github", "google", "facebook", "microsoft", "amazon", "portier"}
 MAX_COLUMNS = 160
+STATS_JOB_TTL = 24 * 3600  # keep reference to latest stats job for a day
+MAX_PROJECT_INDEXES = int(os.environ.get("MAX_PROJECT_INDEXES", 5))
+MAX_INDEXES = 64  # per collection in MongoDB
+INDEXES_KEY = f"{STATS_QUEUE}:indexes"
+logger = get_logger(__name__)
 
 
 def visit(path, key, value):
@@ -117,6 +129,7 @@ class Stats(EmbeddedDocument):
     structures = IntField(required=True, default=0, help_text="#structures")
     attachments = IntField(required=True, default=0, help_text="#attachments")
     size = DecimalField(required=True, default=0, precision=1, help_text="size in MB")
+    indexes = ListField(StringField(), default=list, help_text="indexed columns")
 
 
 class Projects(Document):
@@ -194,10 +207,13 @@ class Projects(Document):
     @classmethod
     def atlas_filter(cls, term):
         # NOTE dynamic index, use `name` as placeholder for wildcard path
+        # set here since accessing `atlas` needs a database connection (not on import)
+        cls.atlas.index._set_indexed_fields({"type": "document", "dynamic": True})
         return AtlasQ(name=term)
 
     @classmethod
     def post_save(cls, sender, document, **kwargs):
+        invalidate("projects")
         admin_email = current_app.config["MAIL_DEFAULT_SENDER"]
         scheme = "http" if current_app.config["DEBUG"] else "https"
 
@@ -236,137 +252,14 @@ class Projects(Document):
                 or "columns" in delta_unset
                 or (not delta_set and not delta_unset)
             ):
-                from mpcontribs.api.contributions.document import (
-                    Contributions,
-                    COMPONENTS,
-                )
-
-                columns = {}
-                ncontribs = Contributions.objects(project=document.id).count()
-
-                if "columns" in delta_set:
-                    # document.columns updated by the user as intended
-                    for col in document.columns:
-                        columns[col.path] = col
-                elif "columns" in delta_unset or ncontribs:
-                    # document.columns unset by user to reinit all columns from DB
-                    # -> get paths and units across all contributions from DB
-                    pipeline = [
-                        {"$match": {"project": document.id}},
-                        {"$sample": {"size": 1000}},
-                        {"$project": {"data": 1}},
-                    ]
-                    result = Contributions.objects.aggregate(pipeline)
-                    merged = ChainMap(*result)
-                    flat = flatten(
-                        remap(merged, visit=visit, enter=enter), reducer="dot"
-                    )
-
-                    for k, v in flat.items():
-                        if k.startswith("data."):
-                            columns[k] = Column(path=k)
-                            if v is not None:
-                                columns[k].unit = v
-
-                # start pipeline for stats: match project
-                pipeline = [{"$match": {"project": document.id}}]
-
-                # resolve/lookup component fields
-                # NOTE also includes dynamic document fields
-                # for component in COMPONENTS.keys():
-                #    pipeline.append(
-                #        {
-                #            "$lookup": {
-                #                "from": component,
-                #                "localField": component,
-                #                "foreignField": "_id",
-                #                "as": component,
-                #            }
-                #        }
-                #    )
-
-                # document size and attachment content size
-                project_stage = {
-                    #    "_id": 0,
-                    #    "size": {"$bsonSize": "$$ROOT"},
-                    #    "contents": {
-                    #        "$map": {  # attachment sizes
-                    #            "input": "$attachments",
-                    #            "as": "attm",
-                    #            "in": {"$toInt": "$$attm.content"},
-                    #        }
-                    #    },
-                }
-
-                # number of components
-                for component in COMPONENTS.keys():
-                    project_stage[component] = {"$size": f"${component}"}
-
-                # filter/forward number columns
-                min_max_paths = [
-                    path for path, col in columns.items() if col["unit"] != "NaN"
-                ]
-                for path in min_max_paths:
-                    field = f"{path}{delimiter}value"
-                    project_stage[field] = {
-                        "$cond": {
-                            "if": {"$isNumber": f"${field}"},
-                            "then": f"${field}",
-                            "else": "$$REMOVE",
-                        }
-                    }
-
-                # add project stage to pipeline
-                pipeline.append({"$project": project_stage})
-
-                # forward fields and sum attachment contents
-                project_stage_2 = {k: 1 for k in project_stage.keys()}
-                # project_stage_2["contents"] = {"$sum": "$contents"}
-                pipeline.append({"$project": project_stage_2})
-
-                # total size and total number of components
-                group_stage = {
-                    "_id": None,
-                    #    "size": {"$sum": {"$add": ["$size", "$contents"]}},
-                }
-                for component in COMPONENTS.keys():
-                    group_stage[component] = {"$sum": f"${component}"}
-
-                # determine min/max for columns
-                for path in min_max_paths:
-                    field = f"{path}{delimiter}value"
-                    for k in ["min", "max"]:
-                        clean_path = path.replace(delimiter, "__")
-                        key = f"{clean_path}__{k}"
-                        group_stage[key] = {f"${k}": f"${field}"}
-
-                # append group stage and run pipeline
-                pipeline.append({"$group": group_stage})
-                result = list(Contributions.objects.aggregate(pipeline))
-
-                # set min/max for columns
-                min_max = {} if not result else result[0]
-                for clean_path in min_max_paths:
-                    for k in ["min", "max"]:
-                        path = clean_path.replace(delimiter, "__")
-                        m = min_max.get(f"{path}__{k}")
-                        if m is not None:
-                            setattr(columns[clean_path], k, m)
-
-                # prep and save stats
-                stats_kwargs = {"columns": len(columns), "contributions": ncontribs}
-                if result and result[0]:
-                    # stats_kwargs["size"] = result[0]["size"] / 1024 / 1024
-                    for component in COMPONENTS.keys():
-                        stats_kwargs[component] = result[0].get(component, 0)
-                        if stats_kwargs[component] > 0:
-                            columns[component] = Column(path=component)
-
-                stats = Stats(**stats_kwargs)
-                document.update(stats=stats, columns=columns.values())
+                # columns set by the user are kept, otherwise re-initialized from DB
+                reinit = "columns" not in delta_set
+                queue_stats(document.name, reinit=reinit)
 
     @classmethod
     def post_delete(cls, sender, document, **kwargs):
+        invalidate("projects")
+        queue_indexes(document.name, [])  # drop partial indexes of project in background
         admin_email = current_app.config["MAIL_DEFAULT_SENDER"]
         subject = f'Your project "{document.name}" has been deleted'
         html = render_template(
@@ -379,9 +272,265 @@ class Projects(Document):
         send_email(owner_email, subject, html)
 
 
+def get_stats_job(name, key=STATS_QUEUE):
+    """retrieve latest stats (or indexes) job for a project (None if not available)"""
+    job_id = rq.connection.get(f"{key}:{name}")
+    if not job_id:
+        return None
+
+    try:
+        return Job.fetch(job_id.decode(), connection=rq.connection)
+    except NoSuchJobError:
+        return None
+
+
+def queue_stats(name, reinit=True):
+    """queue (deduplicated) job to update columns and stats for a project"""
+    try:
+        job = get_stats_job(name)
+    except RedisConnectionError:
+        logger.warning(f"RQ not available, updating stats for {name} synchronously")
+        update_stats(name, reinit=reinit)
+        return None
+
+    status = job.get_status() if job else None
+    pending = {JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED}
+
+    if status in pending and job.kwargs.get("reinit") == reinit:
+        logger.debug(f"stats job {job.id} for {name} already queued")
+        return job.id
+
+    # run after currently started or pending job to avoid concurrent updates
+    depends_on = job if status in pending | {JobStatus.STARTED} else None
+    job = update_stats.queue(name, reinit=reinit, depends_on=depends_on)
+    rq.connection.set(f"{STATS_QUEUE}:{name}", job.id, ex=STATS_JOB_TTL)
+    return job.id
+
+
+@rq.job(STATS_QUEUE, timeout=600)
+def update_stats(name, reinit=True):
+    """update project columns and stats from its contributions"""
+    from mpcontribs.api.contributions.document import Contributions, COMPONENTS
+
+    document = Projects.objects.with_id(name)
+    if document is None:
+        return None
+
+    document.reload("columns")
+    columns = {}
+    ncontribs = Contributions.objects(project=document.id).count()
+
+    if not reinit:
+        # document.columns updated by the user as intended
+        for col in document.columns:
+            columns[col.path] = col
+    elif ncontribs:
+        # document.columns unset by user to reinit all columns from DB
+        # -> get paths and units across all contributions from DB
+        pipeline = [
+            {"$match": {"project": document.id}},
+            {"$sample": {"size": 1000}},
+            {"$project": {"data": 1}},
+        ]
+        result = Contributions.objects.aggregate(pipeline)
+        merged = ChainMap(*result)
+        flat = flatten(remap(merged, visit=visit, enter=enter), reducer="dot")
+
+        for k, v in flat.items():
+            if k.startswith("data."):
+                columns[k] = Column(path=k)
+                if v is not None:
+                    columns[k].unit = v
+
+    # start pipeline for stats: match project
+    pipeline = [{"$match": {"project": document.id}}]
+
+    # resolve/lookup component fields
+    # NOTE also includes dynamic document fields
+    # for component in COMPONENTS.keys():
+    #    pipeline.append(
+    #        {
+    #            "$lookup": {
+    #                "from": component,
+    #                "localField": component,
+    #                "foreignField": "_id",
+    #                "as": component,
+    #            }
+    #        }
+    #    )
+
+    # document size and attachment content size
+    project_stage = {
+        #    "_id": 0,
+        #    "size": {"$bsonSize": "$$ROOT"},
+        #    "contents": {
+        #        "$map": {  # attachment sizes
+        #            "input": "$attachments",
+        #            "as": "attm",
+        #            "in": {"$toInt": "$$attm.content"},
+        #        }
+        #    },
+    }
+
+    # number of components
+    for component in COMPONENTS.keys():
+        project_stage[component] = {"$size": f"${component}"}
+
+    # filter/forward number columns
+    min_max_paths = [path for path, col in columns.items() if col["unit"] != "NaN"]
+    for path in min_max_paths:
+        field = f"{path}{delimiter}value"
+        project_stage[field] = {
+            "$cond": {
+                "if": {"$isNumber": f"${field}"},
+                "then": f"${field}",
+                "else": "$$REMOVE",
+            }
+        }
+
+    # add project stage to pipeline
+    pipeline.append({"$project": project_stage})
+
+    # forward fields and sum attachment contents
+    project_stage_2 = {k: 1 for k in project_stage.keys()}
+    # project_stage_2["contents"] = {"$sum": "$contents"}
+    pipeline.append({"$project": project_stage_2})
+
+    # total size and total number of components
+    group_stage = {
+        "_id": None,
+        #    "size": {"$sum": {"$add": ["$size", "$contents"]}},
+    }
+    for component in COMPONENTS.keys():
+        group_stage[component] = {"$sum": f"${component}"}
+
+    # determine min/max for columns
+    for path in min_max_paths:
+        field = f"{path}{delimiter}value"
+        for k in ["min", "max"]:
+            clean_path = path.replace(delimiter, "__")
+            key = f"{clean_path}__{k}"
+            group_stage[key] = {f"${k}": f"${field}"}
+
+    # append group stage and run pipeline
+    pipeline.append({"$group": group_stage})
+    result = list(Contributions.objects.aggregate(pipeline))
+
+    # set min/max for columns
+    min_max = {} if not result else result[0]
+    for clean_path in min_max_paths:
+        for k in ["min", "max"]:
+            path = clean_path.replace(delimiter, "__")
+            m = min_max.get(f"{path}__{k}")
+            if m is not None:
+                setattr(columns[clean_path], k, m)
+
+    # prep and save stats
+    stats_kwargs = {"columns": len(columns), "contributions": ncontribs}
+    stats_kwargs["indexes"] = sorted(get_project_indexes(name))
+    if result and result[0]:
+        # stats_kwargs["size"] = result[0]["size"] / 1024 / 1024
+        for component in COMPONENTS.keys():
+            stats_kwargs[component] = result[0].get(component, 0)
+            if stats_kwargs[component] > 0:
+                columns[component] = Column(path=component)
+
+    stats = Stats(**stats_kwargs)
+    document.update(stats=stats, columns=columns.values())
+    invalidate("projects")
+    return stats.to_mongo().to_dict()
+
+
+def get_project_indexes(name, info=None):
+    """map of indexed columns to index names for project (partial compound indexes)"""
+    from mpcontribs.api.contributions.document import Contributions
+
+    if info is None:
+        info = Contributions._get_collection().index_information()
+
+    indexes = {}
+    for index_name, index in info.items():
+        partial = index.get("partialFilterExpression", {})
+        keys = [k for k, _ in index["key"]]
+        if partial.get("project") == name and len(keys) == 2 and keys[0] == "project":
+            indexes[keys[1].rsplit(delimiter, 1)[0]] = index_name
+
+    return indexes
+
+
+def check_indexes(name, columns):
+    """validate requested columns to index for project, return error message"""
+    from mpcontribs.api.contributions.document import Contributions
+
+    if len(columns) > MAX_PROJECT_INDEXES:
+        return f"Only up to {MAX_PROJECT_INDEXES} columns can be indexed per project."
+
+    document = Projects.objects.only("columns").with_id(name)
+    numeric = {col.path for col in document.columns if col.unit != "NaN"}
+    invalid = set(columns) - numeric
+    if invalid:
+        return f"Not numeric columns of {name}: {', '.join(sorted(invalid))}."
+
+    info = Contributions._get_collection().index_information()
+    nindexes = len(info) - len(get_project_indexes(name, info=info)) + len(columns)
+    if nindexes > MAX_INDEXES:
+        return f"Too many indexes on contributions ({nindexes} > {MAX_INDEXES})."
+
+
+def queue_indexes(name, columns):
+    """queue job to build and drop partial compound indexes for project columns"""
+    try:
+        job = get_stats_job(name, key=INDEXES_KEY)
+    except RedisConnectionError:
+        logger.warning(f"RQ not available, updating indexes for {name} synchronously")
+        update_indexes(name, columns)
+        return None
+
+    status = job.get_status() if job else None
+    pending = {JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED}
+
+    if status in pending and job.args[1] == columns:
+        logger.debug(f"indexes job {job.id} for {name} already queued")
+        return job.id
+
+    # index builds on the same project run one after the other
+    depends_on = job if status in pending | {JobStatus.STARTED} else None
+    job = update_indexes.queue(name, columns, depends_on=depends_on)
+    rq.connection.set(f"{INDEXES_KEY}:{name}", job.id, ex=STATS_JOB_TTL)
+    return job.id
+
+
+@rq.job(STATS_QUEUE, timeout=3600)
+def update_indexes(name, columns):
+    """create missing and drop obsolete indexes on `{project: 1, <column>.value: 1}`"""
+    from mpcontribs.api.contributions.document import Contributions
+
+    collection = Contributions._get_collection()
+    indexes = get_project_indexes(name)
+
+    for column, index_name in indexes.items():
+        if column not in columns:
+            collection.drop_index(index_name)
+            logger.info(f"dropped index {index_name}")
+
+    for column in columns:
+        if column not in indexes:
+            index_name = f"project_{name}_{column}"
+            collection.create_index(
+                [("project", 1), (f"{column}{delimiter}value", 1)],
+                name=index_name,
+                partialFilterExpression={"project": name},
+            )
+            logger.info(f"created index {index_name}")
+
+    indexed = sorted(get_project_indexes(name))
+    Projects.objects(name=name).update(set__stats__indexes=indexed)
+    invalidate("projects")
+    return indexed
+
+
 register_field(
     ProviderEmailField, ProviderEmail, available_params=(params.LengthParam,)
 )
 signals.post_save.connect(Projects.post_save, sender=Projects)
 signals.post_delete.connect(Projects.post_delete, sender=Projects)
-Projects.atlas.index._set_indexed_fields({"type": "document", "dynamic": True})
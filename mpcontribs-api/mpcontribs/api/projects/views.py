@@ -9,9 +9,13 @@ from flask_mongorest import operators as ops
 from flask_mongorest.methods import Fetch, Create, Delete, Update, BulkFetch
 from werkzeug.exceptions import Unauthorized
 
-from mpcontribs.api import FILTERS
+from mpcontribs.api import FILTERS, is_admin
 from mpcontribs.api.core import SwaggerView
+from mpcontribs.api.slow_queries import get_hot_columns
 from mpcontribs.api.projects.document import Projects, Column, Reference, Stats
+from mpcontribs.api.projects.document import get_stats_job, get_project_indexes
+from mpcontribs.api.projects.document import check_indexes, queue_indexes
+from mpcontribs.api.projects.document import INDEXES_KEY, MAX_PROJECT_INDEXES
 
 templates = os.path.join(os.path.dirname(flask_mongorest.__file__), "templates")
 projects = Blueprint("projects", __name__, template_folder=templates)
@@ -181,3 +185,63 @@ def search():
     ]
     result = [p["_id"] for p in Projects.objects().aggregate(pipeline)]
     return jsonify(result)
+
+
+@projects.route("/stats/<name>")
+def stats(name):
+    """status of latest job updating columns and stats for a project"""
+    # same permissions as for fetching the project
+    qs = ProjectsView().has_read_permission(request, Projects.objects(name=name))
+    if not qs.count():
+        abort(404, description=f"Project {name} not found.")
+
+    job = get_stats_job(name)
+    if not job:
+        abort(404, description=f"No stats job for {name}.")
+
+    ret = {"id": job.id, "status": job.get_status()}
+    if job.is_finished:
+        ret["result"] = job.result
+    elif job.is_failed:
+        # tracebacks for admins only
+        ret["exc"] = job.exc_info if is_admin() else "Updating stats failed."
+
+    return jsonify(ret)
+
+
+@projects.route("/indexes/<name>", methods=["GET", "PUT"])
+def indexes(name):
+    """list or set columns of project with partial compound index (admins only)
+
+    PUT `{"columns": [...]}` to index numeric columns, or without columns to index
+    the columns most used in slow queries of the project (see slow_queries.py).
+    """
+    if not is_admin():
+        abort(403, description="Only admins can manage project indexes.")
+
+    if not Projects.objects(name=name).count():
+        abort(404, description=f"Project {name} not found.")
+
+    if request.method == "GET":
+        ret = {"indexes": sorted(get_project_indexes(name))}
+        ret["hot"] = get_hot_columns(name)
+        job = get_stats_job(name, key=INDEXES_KEY)
+        if job:
+            ret["job"] = {"id": job.id, "status": job.get_status()}
+            if job.is_failed:
+                ret["job"]["exc"] = job.exc_info
+
+        return jsonify(ret)
+
+    columns = (request.get_json(silent=True) or {}).get("columns")
+    if columns is None:
+        columns = get_hot_columns(name)[:MAX_PROJECT_INDEXES]
+    elif not isinstance(columns, list):
+        abort(400, description="`columns` must be a list of column paths.")
+
+    error = check_indexes(name, columns)
+    if error:
+        abort(400, description=error)
+
+    job_id = queue_indexes(name, sorted(columns))
+    return jsonify({"id": job_id, "columns": sorted(columns)}), 202
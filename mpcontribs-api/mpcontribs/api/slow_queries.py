@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Optional recorder for slow Mongo queries issued while handling requests
+
+Enable with SLOW_QUERY_MS. Find, count and aggregate commands taking longer are
+grouped by query shape (filter and pipeline values stripped) in Redis together with
+an example, the endpoint and a summary of the query planner's winning plan (explain
+runs once per shape in a stats job). Admins list the worst offenders by total time
+via /slow_queries/ to add targeted indexes, and reset the list with DELETE.
+"""
+import os
+import json
+
+from hashlib import md5
+from flask import request, jsonify, abort, g, has_request_context
+from pymongo import monitoring
+from redis.exceptions import RedisError
+from mongoengine.connection import get_db
+
+from mpcontribs.api import rq, get_logger, is_admin, MPCONTRIBS_API_HOST, STATS_QUEUE
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 0))  # disabled if 0
+SLOW_QUERY_MAX = int(os.environ.get("SLOW_QUERY_MAX", 500))  # shapes kept
+SLOW_QUERY_TTL = int(os.environ.get("SLOW_QUERY_TTL", 7 * 24 * 3600))  # seconds
+SLOW_PREFIX = f"slow_{MPCONTRIBS_API_HOST}"
+# command -> query fields to record and explain
+COMMANDS = {
+    "find": ["filter", "sort", "projection", "limit", "skip"],
+    "count": ["query", "limit", "skip"],
+    "aggregate": ["pipeline"],
+}
+
+# atomically raise max_ms of shape (HGET and HSET from concurrent requests could interleave)
+MAX_MS_SCRIPT = """
+local max_ms = tonumber(redis.call('HGET', KEYS[1], 'max_ms'))
+if not max_ms or tonumber(ARGV[1]) > max_ms then
+    redis.call('HSET', KEYS[1], 'max_ms', ARGV[1])
+end
+"""
+# keep worst shapes and delete hashes of shapes trimmed from zset
+TRIM_SCRIPT = """
+local trimmed = redis.call('ZRANGE', KEYS[1], 0, ARGV[1])
+for _, fingerprint in ipairs(trimmed) do
+    redis.call('DEL', ARGV[2] .. ':' .. fingerprint)
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, ARGV[1])
+return #trimmed
+"""
+
+logger = get_logger(__name__)
+listener = None
+
+
+def shape(value):
+    """replace values in query with type placeholders (keep keys and operators)"""
+    if isinstance(value, dict):
+        return {k: shape(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        shapes = [shape(v) for v in value]
+        # keep pipeline stages and $and/$or clauses, collapse $in/$all values
+        return shapes if any(isinstance(v, dict) for v in value) else shapes[:1]
+
+    return type(value).__name__
+
+
+def get_fingerprint(command):
+    collection = command[next(iter(command))]
+    query = {
+        k: v if k in {"sort", "projection"} else shape(v)
+        for k, v in command.items()
+        if k not in {"limit", "skip"}
+    }
+    query[next(iter(command))] = collection
+    digest = md5(json.dumps(query, sort_keys=True).encode("utf-8")).hexdigest()
+    return digest, query
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """collect slow commands of current request"""
+
+    def started(self, event):
+        if event.command_name in COMMANDS and has_request_context():
+            started = g.setdefault("mongo_commands", {})
+            fields = COMMANDS[event.command_name]
+            command = {event.command_name: event.command[event.command_name]}
+            command.update((k, event.command[k]) for k in fields if k in event.command)
+            started[event.request_id] = command
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        self.finished(event)
+
+    def finished(self, event):
+        if not has_request_context():
+            return
+
+        command = g.get("mongo_commands", {}).pop(event.request_id, None)
+        ms = event.duration_micros / 1000
+        if command is not None and ms >= SLOW_QUERY_MS:
+            g.setdefault("slow_queries", []).append((command, ms))
+
+
+def store_slow_queries(exc):
+    """group slow commands of request by shape and queue explain for new shapes"""
+    slow_queries = g.pop("slow_queries", None)
+    if not slow_queries:
+        return
+
+    worst = f"{SLOW_PREFIX}:worst"
+    try:
+        for command, ms in slow_queries:
+            fingerprint, query = get_fingerprint(command)
+            key = f"{SLOW_PREFIX}:{fingerprint}"
+            example = {
+                "endpoint": request.endpoint,
+                "url": request.full_path,
+                "shape": query,
+                "command": command,
+            }
+            pipe = rq.connection.pipeline()
+            pipe.hincrby(key, "count", 1)
+            pipe.hincrbyfloat(key, "total_ms", ms)
+            pipe.eval(MAX_MS_SCRIPT, 1, key, ms)
+            pipe.hset(key, "example", json.dumps(example, default=str))
+            pipe.expire(key, SLOW_QUERY_TTL)
+            pipe.zincrby(worst, ms, fingerprint)
+            pipe.eval(TRIM_SCRIPT, 1, worst, -SLOW_QUERY_MAX - 1, SLOW_PREFIX)
+            count, *_ = pipe.execute()
+
+            if count == 1:
+                explain.queue(fingerprint, command)
+    except RedisError as ex:
+        logger.warning(f"failed to record slow queries: {ex}")
+
+
+@rq.job(STATS_QUEUE, timeout=60)
+def explain(fingerprint, command):
+    """summarize query planner's winning plan for slow command"""
+    if "aggregate" in command:
+        command = dict(command, cursor={})
+
+    result = get_db().command({"explain": command, "verbosity": "queryPlanner"})
+    stages, indexes = [], []
+    if "queryPlanner" not in result:  # aggregation with $cursor stage
+        result = result["stages"][0]["$cursor"]
+
+    plan = result["queryPlanner"]["winningPlan"]
+    plan = plan.get("queryPlan", plan)  # slot-based execution engine
+
+    while plan:
+        stages.append(plan["stage"])
+        if "indexName" in plan:
+            indexes.append(plan["indexName"])
+
+        plan = plan.get("inputStage") or next(iter(plan.get("inputStages", [])), None)
+
+    summary = {"stages": stages, "indexes": indexes, "collscan": "COLLSCAN" in stages}
+    rq.connection.hset(f"{SLOW_PREFIX}:{fingerprint}", "plan", json.dumps(summary))
+    return summary
+
+
+def slow_queries():
+    """worst slow query shapes by total time (admins only)"""
+    if not is_admin():
+        abort(403, description="slow queries only available to admins")
+
+    worst = f"{SLOW_PREFIX}:worst"
+    try:
+        if request.method == "DELETE":
+            fingerprints = rq.connection.zrange(worst, 0, -1)
+            keys = [f"{SLOW_PREFIX}:{fp.decode('utf-8')}" for fp in fingerprints]
+            rq.connection.delete(worst, *keys)
+            return jsonify({"count": len(keys)})
+
+        limit = request.args.get("limit", 20, type=int)
+        fingerprints = rq.connection.zrevrange(worst, 0, limit - 1)
+        pipe = rq.connection.pipeline()
+        for fp in fingerprints:
+            pipe.hgetall(f"{SLOW_PREFIX}:{fp.decode('utf-8')}")
+
+        entries = pipe.execute()
+    except RedisError as ex:
+        return jsonify({"error": str(ex)}), 503
+
+    ret = []
+    for fp, entry in zip(fingerprints, entries):
+        if not entry:
+            continue  # expired
+
+        count = int(entry[b"count"])
+        total_ms = float(entry[b"total_ms"])
+        ret.append(
+            {
+                "fingerprint": fp.decode("utf-8"),
+                "count": count,
+                "total_ms": round(total_ms, 1),
+                "mean_ms": round(total_ms / count, 1),
+                "max_ms": round(float(entry.get(b"max_ms", 0)), 1),
+                "plan": json.loads(entry[b"plan"]) if b"plan" in entry else None,
+                **json.loads(entry[b"example"]),
+            }
+        )
+
+    return jsonify(ret)
+
+
+def get_hot_columns(project):
+    """data columns filtered or sorted on in slow queries for project by total time"""
+    worst = rq.connection.zrevrange(f"{SLOW_PREFIX}:worst", 0, -1, withscores=True)
+    pipe = rq.connection.pipeline()
+    for fp, _ in worst:
+        pipe.hget(f"{SLOW_PREFIX}:{fp.decode('utf-8')}", "example")
+
+    totals = {}
+    for (_, total_ms), example in zip(worst, pipe.execute()):
+        if not example:
+            continue  # expired
+
+        command = json.loads(example)["command"]
+        query = command.get("filter", command.get("query", {}))
+        if query.get("project") != project:
+            continue
+
+        for path in list(query) + list(command.get("sort", {})):
+            if path.startswith("data.") and path.endswith(".value"):
+                column = path.rsplit(".", 1)[0]
+                totals[column] = totals.get(column, 0) + total_ms
+
+    return sorted(totals, key=totals.get, reverse=True)
+
+
+def init_slow_queries(app):
+    """record slow queries if enabled - call before MongoEngine to monitor its client"""
+    global listener
+    if SLOW_QUERY_MS <= 0:
+        return
+
+    if listener is None:
+        listener = SlowQueryListener()
+        monitoring.register(listener)
+
+    app.teardown_request(store_slow_queries)
+    app.add_url_rule(
+        "/slow_queries/", view_func=slow_queries, methods=["GET", "DELETE"]
+    )
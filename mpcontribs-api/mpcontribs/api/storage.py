@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Object storage for attachments and notebook images (S3 or local filesystem)"""
+import os
+import boto3
+
+from pathlib import Path
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from mpcontribs.api.metrics import timed
+
+STORAGE_BACKEND = os.environ.get("MPCONTRIBS_STORAGE_BACKEND", "s3")  # or "local"
+STORAGE_DIR = os.environ.get("MPCONTRIBS_STORAGE_DIR", "/tmp/mpcontribs-storage")
+STORAGE_CACHE_BYTES = int(os.environ.get("MPCONTRIBS_STORAGE_CACHE_MB", 64)) * 1024 * 1024
+STORAGE_WORKERS = int(os.environ.get("MPCONTRIBS_STORAGE_WORKERS", 8))
+S3_DELETE_BATCH = 1000  # max keys per DeleteObjects request
+URL_EXPIRES = int(os.environ.get("MPCONTRIBS_STORAGE_URL_EXPIRES", 3600))  # seconds
+
+executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS)
+s3_client = boto3.client("s3")
+
+
+class S3Storage:
+    """objects in S3 bucket"""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get(self, key):
+        retr = s3_client.get_object(Bucket=self.bucket, Key=key)
+        return retr["Body"].read()
+
+    def put(self, key, body, content_type=None, metadata=None):
+        kwargs = dict(Bucket=self.bucket, Key=key, Body=body)
+        if content_type:
+            kwargs["ContentType"] = content_type
+        if metadata:
+            kwargs["Metadata"] = metadata
+
+        s3_client.put_object(**kwargs)
+
+    def delete(self, key):
+        s3_client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), S3_DELETE_BATCH):
+            objects = [{"Key": key} for key in keys[i : i + S3_DELETE_BATCH]]
+            s3_client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True}
+            )
+
+    def url(self, key, filename=None, expires=URL_EXPIRES):
+        """presigned URL to download object directly from S3"""
+        params = {"Bucket": self.bucket, "Key": key}
+        if filename:
+            params["ResponseContentDisposition"] = f'attachment; filename="{filename}"'
+
+        return s3_client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=expires
+        )
+
+
+class LocalStorage:
+    """objects as files in bucket directory (tests, on-prem)"""
+
+    def __init__(self, bucket, root=STORAGE_DIR):
+        self.path = Path(root) / bucket
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key):
+        try:
+            return (self.path / key).read_bytes()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def put(self, key, body, content_type=None, metadata=None):
+        tmp = self.path / f".{key}.tmp"
+        tmp.write_bytes(body)
+        tmp.replace(self.path / key)
+
+    def delete(self, key):
+        (self.path / key).unlink(missing_ok=True)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def url(self, key, filename=None, expires=URL_EXPIRES):
+        return None  # not reachable by clients, content only served through API
+
+
+class CachedStorage:
+    """size-bounded LRU cache and concurrent fetches in front of storage backend"""
+
+    def __init__(self, backend, maxbytes=STORAGE_CACHE_BYTES):
+        self.backend = backend
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.cache = OrderedDict()
+        self.lock = Lock()
+
+    def _cache(self, key, body):
+        size = len(body)
+        if size > self.maxbytes:
+            return
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return
+
+            self.cache[key] = body
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def _uncache(self, key):
+        with self.lock:
+            body = self.cache.pop(key, None)
+            if body is not None:
+                self.nbytes -= len(body)
+
+    @timed("storage")
+    def get(self, key):
+        with self.lock:
+            body = self.cache.get(key)
+            if body is not None:
+                self.cache.move_to_end(key)
+                return body
+
+        body = self.backend.get(key)
+        self._cache(key, body)
+        return body
+
+    def submit(self, key):
+        """start fetching object in background and return future"""
+        return executor.submit(self.get, key)
+
+    @timed("storage")
+    def get_many(self, keys):
+        """fetch objects concurrently and return dict of key -> bytes"""
+        futures = {key: self.submit(key) for key in set(keys)}
+        return {key: future.result() for key, future in futures.items()}
+
+    @timed("storage")
+    def put(self, key, body, content_type=None, metadata=None):
+        self.backend.put(key, body, content_type=content_type, metadata=metadata)
+        self._cache(key, body)
+
+    @timed("storage")
+    def delete(self, key):
+        self._uncache(key)
+        self.backend.delete(key)
+
+    @timed("storage")
+    def delete_many(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self._uncache(key)
+
+        self.backend.delete_many(keys)
+
+    @timed("storage")
+    def url(self, key, filename=None, expires=URL_EXPIRES):
+        """URL for direct download of object or None if not supported by backend"""
+        return self.backend.url(key, filename=filename, expires=expires)
+
+
+BACKENDS = {"s3": S3Storage, "local": LocalStorage}
+_storages = {}
+
+
+def get_storage(bucket):
+    """cached storage for bucket using configured backend"""
+    if bucket not in _storages:
+        backend = BACKENDS[STORAGE_BACKEND](bucket)
+        _storages[bucket] = CachedStorage(backend)
+
+    return _storages[bucket]
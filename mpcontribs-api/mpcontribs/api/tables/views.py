@@ -51,6 +51,14 @@ class TablesResource(Resource):
     def get_optional_fields():
         return ["index", "data"]
 
+    def apply_field_pagination(self, qs, params=None):
+        # $slice projection includes data, only apply if rows requested
+        requested_fields = self.get_requested_fields(params=params or self.params)
+        if "data" not in requested_fields:
+            return qs
+
+        return super().apply_field_pagination(qs, params=params)
+
     def value_for_field(self, obj, field):
         if field == "total_data_pages":
             if obj.total_data_rows is None:
@@ -0,0 +1,78 @@
+"""benchmark JSON providers on a contributions BulkFetch payload
+
+usage: python scripts/benchmark_json.py [nobjs] [repeat]
+"""
+import sys
+import timeit
+
+from random import random, choice
+from decimal import Decimal
+from datetime import datetime
+from bson.objectid import ObjectId
+from flask import Flask
+from flask_mongorest.views import render_json
+from mpcontribs.api import JSON_PROVIDERS, orjson_default
+
+UNITS = ["eV", "eV/atom", "GPa", "K", "", "mΩ·cm"]
+
+
+def quantity():
+    value = random() * 100
+    unit = choice(UNITS)
+    return {
+        "display": f"{value:.3g} {unit}".strip(),
+        "value": value,
+        "error": random(),
+        "unit": unit,
+    }
+
+
+def contribution(idx):
+    return {
+        "id": ObjectId(),
+        "project": "benchmark",
+        "identifier": f"mp-{idx}",
+        "formula": "Fe2O3",
+        "is_public": True,
+        "last_modified": datetime.utcnow(),
+        "needs_build": False,
+        "data": {
+            "method": "PBE+U",
+            "composition": {"Fe": Decimal("0.4"), "O": Decimal("0.6")},
+            "bandgap": {"direct": quantity(), "indirect": quantity()},
+            "elastic": {k: quantity() for k in ["bulk", "shear", "poisson"]},
+            "thermo": {str(t): quantity() for t in range(300, 1300, 100)},
+        },
+        "structures": [{"id": ObjectId(), "name": "relaxed"}],
+        "tables": [{"id": ObjectId(), "name": "dos"}],
+    }
+
+
+def main(nobjs=1500, repeat=10):
+    app = Flask(__name__)
+    payload = {
+        "data": [contribution(i) for i in range(nobjs)],
+        "has_more": True,
+        "total_count": 100 * nobjs,
+        "total_pages": 100,
+    }
+    default = JSON_PROVIDERS["default"](app)
+    fast = JSON_PROVIDERS["orjson"](app)
+    default.sort_keys = fast.sort_keys = False  # as in create_app
+    candidates = {
+        "flask default (json)": lambda: default.dumps(payload, default=orjson_default),
+        "orjson provider": lambda: fast.dumps(payload),
+        "orjson provider (bytes)": lambda: fast.dumpb(payload),
+        "flask-mongorest render_json": lambda: render_json(**payload),
+    }
+
+    print(f"{nobjs} contributions, best of {repeat}:")
+    baseline = None
+    for name, func in candidates.items():
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        baseline = baseline or best
+        print(f"{name:>30}: {best * 1000:8.1f} ms ({baseline / best:4.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
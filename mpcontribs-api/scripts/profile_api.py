@@ -0,0 +1,79 @@
+"""profile API requests against in-memory mongomock and print Server-Timing phases
+
+usage: MPCONTRIBS_MONGO_HOST=mongomock python scripts/profile_api.py [ncontribs] [repeat]
+"""
+import os
+import sys
+
+from datetime import datetime
+
+os.environ.setdefault("MPCONTRIBS_MONGO_HOST", "mongomock")
+os.environ.setdefault("MPCONTRIBS_STORAGE_BACKEND", "local")
+os.environ.setdefault("REDIS_ADDRESS", "localhost")
+
+from mpcontribs.api import create_app  # noqa: E402
+
+HEADERS = {
+    "X-Consumer-Groups": "admin",
+    "X-Consumer-Username": "profile:api",
+    "Cache-Control": "no-cache",  # skip response cache
+}
+PROJECT = "profile_api"
+ENDPOINTS = [
+    "/projects/",
+    f"/contributions/?project={PROJECT}&_limit=100",
+    f"/contributions/?project={PROJECT}&_fields=id,identifier,data&_limit=500",
+    f"/contributions/?project={PROJECT}&data__energy__value__gt=50&_limit=100",
+]
+
+
+def seed(db, ncontribs):
+    now = datetime.utcnow()
+    db.projects.insert_one(
+        {
+            "_id": PROJECT,
+            "title": "Profiling",
+            "authors": "MPContribs",
+            "description": "in-memory project to profile API requests",
+            "owner": HEADERS["X-Consumer-Username"],
+            "is_public": True,
+            "is_approved": True,
+            "columns": [{"path": "data.energy", "unit": "eV"}],
+        }
+    )
+    db.contributions.insert_many(
+        [
+            {
+                "project": PROJECT,
+                "identifier": f"mp-{i}",
+                "formula": "Fe2O3",
+                "is_public": True,
+                "last_modified": now,
+                "needs_build": False,
+                "data": {"energy": {"display": f"{i % 100} eV", "value": i % 100}},
+            }
+            for i in range(ncontribs)
+        ]
+    )
+
+
+def main(ncontribs=1000, repeat=5):
+    app = create_app()
+    with app.app_context():
+        from mpcontribs.api.contributions.document import Contributions
+
+        seed(Contributions._get_db(), ncontribs)
+
+    with app.test_client() as client:
+        for url in ENDPOINTS:
+            print(url)
+            for _ in range(repeat):
+                resp = client.get(url, headers=HEADERS)
+                print(f"  {resp.status_code} {resp.headers.get('Server-Timing')}")
+
+        metrics = client.get("/metrics").get_data(as_text=True)
+        print(f"/metrics: {len(metrics.splitlines())} lines")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -5,7 +5,7 @@ zzz=$((DEPLOYMENT * 60))
 echo "$SUPERVISOR_PROCESS_NAME: waiting for $zzz seconds before start..."
 sleep $zzz
 
-CMD="flask rq $1"
+CMD="flask rq $*"
 set -x
 
 if [[ -n "$DD_TRACE_HOST" ]]; then
@@ -17,6 +17,7 @@ from inspect import getfullargspec
 from math import isclose
 from pathlib import Path
 from tempfile import gettempdir
+from threading import Lock
 from typing import Type
 from urllib.parse import urlparse
 
@@ -28,7 +29,7 @@ import ujson
 from boltons.iterutils import remap
 from bravado.client import SwaggerClient
 from bravado.config import bravado_config_from_config_dict
-from bravado.exception import HTTPNotFound
+from bravado.exception import HTTPNotFound, HTTPNotModified
 from bravado.requests_client import RequestsClient
 from bravado.swagger_model import Loader
 from bravado_core.formatter import SwaggerFormat
@@ -72,6 +73,9 @@ MEGABYTES = 1024 * 1024
 MAX_BYTES = 2.4 * MEGABYTES
 MAX_PAYLOAD = 15 * MEGABYTES
 MAX_COLUMNS = 160
+STATS_POLL_INTERVAL = 2  # seconds
+ETAG_CACHE_BYTES = 50 * MEGABYTES  # response bytes of results kept for revalidation
+DOWNLOAD_CHUNK_SIZE = MEGABYTES
 DEFAULT_HOST = "contribs-api.materialsproject.org"
 BULMA = "is-narrow is-fullwidth has-background-light"
 PROVIDERS = {"github", "google", "facebook", "microsoft", "amazon"}
@@ -124,6 +128,9 @@ ureg.define("sccm = cm³/min")
 LOG_LEVEL = os.environ.get("MPCONTRIBS_CLIENT_LOG_LEVEL", "INFO")
 log_level = getattr(logging, LOG_LEVEL.upper())
 _session = requests.Session()
+# ETag, result and response size per GET request, shared by client threads
+_etags = LRUCache(maxsize=ETAG_CACHE_BYTES, getsizeof=lambda entry: entry[2])
+_etags_lock = Lock()
 _ipython = sys.modules["IPython"].get_ipython()
 
 
@@ -251,6 +258,20 @@ def _compress(data):
     return len(content), content
 
 
+def _stream_to_file(url: str, path: Path) -> Path:
+    """stream content at (presigned) URL to file without loading it into memory"""
+    tmp = path.with_name(f".{path.name}.part")
+
+    with requests.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        with tmp.open("wb") as f:
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+    tmp.replace(path)
+    return path
+
+
 def get_session(session=None):
     adapter_kwargs = dict(
         max_retries=Retry(
@@ -479,7 +500,12 @@ class Attachment(dict):
     """Wrapper class around dict to handle attachments"""
 
     def decode(self) -> bytes:
-        """Decode base64-encoded content of attachment"""
+        """Decode base64-encoded content of attachment (or download it via content URL)"""
+        if "content" not in self and self.get("content_url"):
+            resp = requests.get(self["content_url"], timeout=60)
+            resp.raise_for_status()
+            return resp.content
+
         return b64decode(self["content"], validate=True)
 
     def unpack(self) -> str:
@@ -498,6 +524,10 @@ class Attachment(dict):
         """
         outdir = outdir or "."
         path = Path(outdir) / self.name
+
+        if "content" not in self and self.get("content_url"):
+            return _stream_to_file(self["content_url"], path)
+
         content = self.decode()
         path.write_bytes(content)
         return path
@@ -593,7 +623,7 @@ class Attachment(dict):
         Args:
             dct (dict): dictionary format of attachment
         """
-        keys = {"id", "name", "md5", "content", "mime"}
+        keys = {"id", "name", "md5", "content", "content_url", "mime"}
         return cls((k, v) for k, v in dct.items() if k in keys)
 
 
@@ -1091,6 +1121,55 @@ class Client(SwaggerClient):
         setattr(future, "track_id", track_id)
         return future
 
+    def _get_conditional(self, resource: str, op: str, **kwargs):
+        """run GET operation with `If-None-Match` header, re-use result if unchanged"""
+        key = get_md5(
+            {"headers": self.headers_json, "url": self.url, "op": op, "params": kwargs}
+        )
+        with _etags_lock:
+            etag, result, _ = _etags.get(key, (None, None, 0))
+
+        request_options = {"headers": {"If-None-Match": etag}} if etag else {}
+        operation = getattr(getattr(self, resource), op)
+
+        try:
+            response = operation(_request_options=request_options, **kwargs).response()
+        except HTTPNotModified:
+            return deepcopy(result)
+
+        etag = response.incoming_response.headers.get("ETag")
+        size = len(response.incoming_response.raw_bytes)
+        if etag and size <= ETAG_CACHE_BYTES:
+            with _etags_lock:
+                _etags[key] = (etag, deepcopy(response.result), size)
+
+        return response.result
+
+    def _wait_for_stats(self, name: str, timeout: int = 600):
+        """Wait for the server-side job updating columns and stats of a project
+
+        Args:
+            name (str): name of the project
+            timeout (int): stop waiting after timeout is exceeded (in seconds)
+        """
+        url = f"{self.url}/projects/stats/{name}"
+        start = time.perf_counter()
+
+        while time.perf_counter() - start < timeout:
+            resp = self.session.get(url, headers=self.headers).result()
+            if resp.status_code != 200:
+                return None  # no stats job (or stats updated synchronously)
+
+            ret = resp.json()
+            if ret["status"] == "finished":
+                return ret.get("result")
+            elif ret["status"] in {"failed", "stopped", "canceled"}:
+                raise MPContribsClientError(f"Updating stats for {name} failed: {ret}")
+
+            time.sleep(STATS_POLL_INTERVAL)
+
+        logger.warning(f"Stats for {name} still updating after {timeout}s.")
+
     def available_query_params(
         self,
         startswith: tuple | None = None,
@@ -1124,7 +1203,11 @@ class Client(SwaggerClient):
             )
 
         fields = fields or ["_all"]  # retrieve all fields by default
-        return Dict(self.projects.getProjectByName(pk=name, _fields=fields).result())
+        return Dict(
+            self._get_conditional(
+                "projects", "getProjectByName", pk=name, _fields=fields
+            )
+        )
 
     def query_projects(
         self,
@@ -1368,7 +1451,9 @@ class Client(SwaggerClient):
             fields = list(self.get_model("ContributionsSchema")._properties.keys())
             fields.remove("needs_build")  # internal field
         return Dict(
-            self.contributions.getContributionById(pk=cid, _fields=fields).result()
+            self._get_conditional(
+                "contributions", "getContributionById", pk=cid, _fields=fields
+            )
         )
 
     def get_table(self, tid_or_md5: str) -> Table:
@@ -1397,9 +1482,14 @@ class Client(SwaggerClient):
         page, pages = 1, None
 
         while pages is None or page <= pages:
-            resp = self.tables.getTableById(
-                pk=tid, _fields=["_all"], data_page=page, data_per_page=per_page
-            ).result()
+            resp = self._get_conditional(
+                "tables",
+                "getTableById",
+                pk=tid,
+                _fields=["_all"],
+                data_page=page,
+                data_per_page=per_page,
+            )
             table["data"].extend(resp["data"])
             if pages is None:
                 pages = resp["total_data_pages"]
@@ -1438,14 +1528,21 @@ class Client(SwaggerClient):
             sid = sid_or_md5
 
         fields = list(self.get_model("StructuresSchema")._properties.keys())
-        resp = self.structures.getStructureById(pk=sid, _fields=fields).result()
+        resp = self._get_conditional(
+            "structures", "getStructureById", pk=sid, _fields=fields
+        )
         return Structure.from_dict(resp)
 
-    def get_attachment(self, aid_or_md5: str) -> Attachment:
+    def get_attachment(self, aid_or_md5: str, download: bool = True) -> Attachment:
         """Retrieve an attachment
 
+        Content is downloaded directly from storage via its `content_url` when the
+        API provides one, and only falls back to base64-encoded `content` otherwise.
+
         Args:
             aid_or_md5 (str): ObjectId or MD5 hash digest for attachment
+            download (bool): include `content`, or only its `content_url` if available
+                (to stream large attachments to disk with `Attachment.write`)
         """
         str_len = len(aid_or_md5)
         if str_len not in {24, 32}:
@@ -1465,8 +1562,20 @@ class Client(SwaggerClient):
         else:
             aid = aid_or_md5
 
+        # NOTE presigned content URLs expire, no conditional request
+        fields = ["id", "name", "mime", "md5", "content_url"]
+        attm = self.attachments.getAttachmentById(pk=aid, _fields=fields).result()
+        if attm.get("content_url"):
+            attm = Attachment(attm)
+            if download:
+                attm["content"] = b64encode(attm.decode()).decode("utf-8")
+
+            return attm
+
         return Attachment(
-            self.attachments.getAttachmentById(pk=aid, _fields=["_all"]).result()
+            self._get_conditional(
+                "attachments", "getAttachmentById", pk=aid, _fields=["_all"]
+            )
         )
 
     def init_columns(
@@ -1626,8 +1735,9 @@ class Client(SwaggerClient):
 
         payload = {"columns": new_columns}
         self._is_valid_payload("Project", payload)
-
-        return self.projects.updateProjectByName(pk=name, project=payload).result()
+        resp = self.projects.updateProjectByName(pk=name, project=payload).result()
+        self._wait_for_stats(name)
+        return resp
 
     def delete_contributions(self, query: dict | None = None, timeout: int = -1):
         """Remove all contributions for a query
@@ -2332,7 +2442,11 @@ class Client(SwaggerClient):
                         if isinstance(element, (str, Path)):
                             element = Attachment.from_file(element)
 
-                        dct = {k: element[k] for k in ["mime", "content"]}
+                        content = element.get("content")
+                        if content is None:  # retrieved without download
+                            content = b64encode(element.decode()).decode("utf-8")
+
+                        dct = {"mime": element["mime"], "content": content}
                     else:
                         raise MPContribsClientError("This should never happen")
 
@@ -2662,6 +2776,7 @@ class Client(SwaggerClient):
         overwrite: bool = False,
         timeout: int = -1,
         fmt: str = "json",
+        as_files: bool = False,
     ) -> list[Path]:
         """Download a list of attachments as a .json.gz file
 
@@ -2671,10 +2786,17 @@ class Client(SwaggerClient):
             overwrite: force re-download
             timeout: cancel remaining requests if timeout exceeded (in seconds)
             fmt: download format - "json" or "csv"
+            as_files: write attachments as individual files in
+                `<outdir>/attachments/<md5>/<name>`, streamed directly from storage
 
         Returns:
             paths of output files
         """
+        if as_files:
+            return self._download_attachment_files(
+                ids=ids, outdir=outdir, overwrite=overwrite, timeout=timeout
+            )
+
         return self._download_resource(
             resource="attachments",
             ids=ids,
@@ -2684,6 +2806,59 @@ class Client(SwaggerClient):
             timeout=timeout,
         )
 
+    def _download_attachment_files(
+        self,
+        ids: list[str],
+        outdir: str | Path = DEFAULT_DOWNLOAD_DIR,
+        overwrite: bool = False,
+        timeout: int = -1,
+    ) -> list[Path]:
+        """Helper to stream a list of attachments to individual files
+
+        Args:
+            ids: list of attachment ObjectIds
+            outdir: optional output directory
+            overwrite: force re-download
+            timeout: cancel remaining downloads if timeout exceeded (in seconds)
+
+        Returns:
+            list of paths to output files
+        """
+        oids = sorted(i for i in ids if ObjectId.is_valid(i))
+        subdir = Path(outdir) / "attachments"
+        fields = ["id", "name", "mime", "md5", "content_url"]
+        per_page = 100  # max_limit for attachments
+        paths, futures = [], []
+
+        for chunk in grouper(per_page, oids):
+            resp = self.attachments.queryAttachments(
+                id__in=list(chunk), _fields=fields, per_page=per_page
+            ).result()
+
+            for attm in resp["data"]:
+                path = subdir / attm["md5"] / attm["name"]
+                paths.append(path)
+
+                if path.exists() and not overwrite:
+                    continue
+
+                path.parent.mkdir(parents=True, exist_ok=True)
+
+                if not attm.get("content_url"):
+                    # storage backend without direct downloads
+                    attm = self.get_attachment(attm["id"])
+
+                future = self.session.executor.submit(
+                    Attachment(attm).write, outdir=path.parent
+                )
+                setattr(future, "track_id", path)
+                futures.append(future)
+
+        if futures:
+            _run_futures(futures, timeout=timeout, desc="Attachments")
+
+        return paths
+
     def _download_resource(
         self,
         resource: str,
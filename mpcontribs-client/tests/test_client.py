@@ -1,10 +1,18 @@
+import json
 import logging
 from unittest.mock import MagicMock, patch
 
 import pytest
+from bravado.exception import HTTPNotModified
 from swagger_spec_validator.common import SwaggerValidationError
 
-from mpcontribs.client import Client, email_format, validate_email
+from mpcontribs.client import (
+    Attachment,
+    Client,
+    MPContribsClientError,
+    email_format,
+    validate_email,
+)
 
 logger = logging.Logger(__name__)
 logger.propagate = True
@@ -64,6 +72,100 @@ def test_mock():
             spec = client.swagger_spec
 
 
+@patch(
+    "bravado.swagger_model.Loader.load_spec",
+    new=MagicMock(
+        return_value={
+            "swagger": "2.0",
+            "paths": {},
+            "info": {"title": "Swagger", "version": "0.0"},
+        }
+    ),
+)
+@patch("mpcontribs.client.STATS_POLL_INTERVAL", new=0)
+def test_wait_for_stats():
+    def mock_response(status_code, json=None):
+        response = MagicMock(status_code=status_code)
+        response.json.return_value = json
+        return MagicMock(result=MagicMock(return_value=response))
+
+    with Client(host="localhost:10000", headers={"a": "b"}) as client:
+        client.session = MagicMock()
+        client.session.get.side_effect = [
+            mock_response(200, {"status": "queued"}),
+            mock_response(200, {"status": "finished", "result": {"columns": 2}}),
+        ]
+        assert client._wait_for_stats("test") == {"columns": 2}
+        assert client.session.get.call_count == 2
+        url = client.session.get.call_args.args[0]
+        assert url == "http://localhost:10000/projects/stats/test"
+
+        client.session.get.side_effect = [mock_response(404)]
+        assert client._wait_for_stats("test") is None
+
+        client.session.get.side_effect = [mock_response(200, {"status": "failed"})]
+        with pytest.raises(MPContribsClientError):
+            client._wait_for_stats("test")
+
+
+@patch(
+    "bravado.swagger_model.Loader.load_spec",
+    new=MagicMock(
+        return_value={
+            "swagger": "2.0",
+            "paths": {},
+            "info": {"title": "Swagger", "version": "0.0"},
+        }
+    ),
+)
+def test_get_conditional():
+    def mock_future(result=None, etag=None, not_modified=False):
+        future = MagicMock()
+        if not_modified:
+            future.response.side_effect = HTTPNotModified(MagicMock(status_code=304))
+        else:
+            future.response.return_value = MagicMock(
+                result=result, incoming_response=MagicMock(headers={"ETag": etag})
+            )
+        return future
+
+    with Client(host="localhost:10000", headers={"a": "b"}) as client:
+        op = MagicMock(
+            side_effect=[
+                mock_future({"id": "1", "data": {"a": 1}}, etag='W/"abc"'),
+                mock_future(not_modified=True),
+            ]
+        )
+        client.contributions = MagicMock(getContributionById=op)
+        kwargs = dict(pk="1", _fields=["id", "data"])
+        args = ("contributions", "getContributionById")
+        first = client._get_conditional(*args, **kwargs)
+        assert op.call_args.kwargs["_request_options"] == {}
+        second = client._get_conditional(*args, **kwargs)
+        headers = op.call_args.kwargs["_request_options"]["headers"]
+        assert headers == {"If-None-Match": 'W/"abc"'}
+        assert first == second == {"id": "1", "data": {"a": 1}}
+        assert first is not second
+
+
+def test_attachment_content_url(tmp_path):
+    content = b"\x1f\x8b" + b"0" * 10
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [content[:4], content[4:]]
+    response.content = content
+    attm = Attachment.from_dict(
+        {"name": "a.gz", "mime": "application/gzip", "content_url": "https://s3/a"}
+    )
+
+    with patch("mpcontribs.client.requests.get", return_value=response) as get:
+        path = attm.write(outdir=tmp_path)
+        assert get.call_args.kwargs["stream"]
+        assert path.read_bytes() == content
+        assert not list(tmp_path.glob(".*.part"))
+        assert attm.decode() == content
+
+
 @pytest.mark.skip(reason="under development")
 def test_request_example(client):
     assert "data" in client.get("/projects/").json
@@ -79,3 +181,55 @@ def test_request_example(client):
     #     with Client(project="test") as contribs_client:
     #         contribs_client.get_project()
     #         mock_result.assert_called_once()
+
+
+@patch(
+    "bravado.swagger_model.Loader.load_spec",
+    new=MagicMock(
+        return_value={
+            "swagger": "2.0",
+            "paths": {},
+            "info": {"title": "Swagger", "version": "0.0"},
+        }
+    ),
+)
+def test_resubmit_fetched_attachment():
+    content = b"\x1f\x8b" + b"0" * 10
+    aid = "0" * 24
+    attm = {"id": aid, "name": "a.gz", "mime": "application/gzip"}
+    attm["content_url"] = "https://s3/a"
+
+    with Client(host="localhost:10000", headers={"a": "b"}) as client:
+        op = MagicMock(return_value=MagicMock(result=MagicMock(return_value=attm)))
+        client.attachments = MagicMock(getAttachmentById=op)
+        model = MagicMock(_properties=dict.fromkeys(["project", "needs_build"]))
+        client.get_model = MagicMock(return_value=model)
+        client._is_valid_payload = MagicMock()
+        client.init_columns = MagicMock()
+        client._reinit = MagicMock()
+        client.session = MagicMock()
+
+        with patch("mpcontribs.client.requests.get") as get:
+            get.return_value = MagicMock(content=content)
+            fetched = client.get_attachment(aid)
+            assert fetched.decode() == content
+
+            url_only = client.get_attachment(aid, download=False)
+            assert "content" not in url_only
+
+            contributions = [
+                {"project": "test", "identifier": str(n), "attachments": [a]}
+                for n, a in enumerate([fetched, url_only])
+            ]
+            with patch(
+                "mpcontribs.client._run_futures", return_value={0: {"count": 2}}
+            ):
+                client.submit_contributions(
+                    contributions, skip_dupe_check=True, ignore_dupes=True
+                )
+
+        payload = client.session.post.call_args.kwargs["data"]
+        submitted = [c["attachments"][0] for c in json.loads(payload)]
+        assert submitted[0] == submitted[1]
+        assert submitted[0]["content"] == fetched["content"]
+        assert submitted[0]["name"] == "a.gz"
@@ -4,5 +4,14 @@ import nbformat as nbf
 
 nb = nbf.v4.new_notebook()
 nb.metadata.kernelspec = {"name": "python3", "display_name": "Python 3"}
-nb.cells = [nbf.v4.new_code_cell("from mpcontribs.client import Client")]
+# pre-import client and modules used to display contributions and their components
+# in prespawned kernels (the API loads its specs into kernels after restarts)
+nb.cells = [nbf.v4.new_code_cell("\n".join([
+    "import psutil",
+    "import plotly.express",
+    "import plotly.io",
+    "from pymatgen.core import Structure",
+    "from IPython.display import display, HTML",
+    "from mpcontribs.client import Client",
+]))]
 nbf.write(nb, "kernel_imports.ipynb")
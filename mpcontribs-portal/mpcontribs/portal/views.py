@@ -9,13 +9,17 @@ import nbformat
 import requests
 import urllib
 
+from hashlib import md5
 from redis import Redis
+from redis.exceptions import RedisError
 from io import BytesIO
 from copy import deepcopy
+from threading import Lock
 from pathlib import Path
 from shutil import make_archive, rmtree
-from nbconvert import HTMLExporter
+from nbconvert import HTMLExporter, __version__ as nbconvert_version
 from bravado.exception import HTTPNotFound
+from cachetools import LRUCache
 from json2html import Json2Html
 from boltons.iterutils import remap
 from botocore.errorfactory import ClientError
@@ -28,10 +32,17 @@ from django.template import RequestContext
 from django.http import HttpResponse, JsonResponse
 from django.template.loader import select_template
 
-from mpcontribs.client import Client, get_md5
+from mpcontribs import portal
+from mpcontribs.client import Client, Dict, get_md5
 
 BUCKET = os.environ.get("S3_DOWNLOADS_BUCKET", "mpcontribs-downloads")
+# download generation refreshes heartbeat at least once per lambda invocation
+DOWNLOAD_HEARTBEAT_TTL = int(os.environ.get("DOWNLOAD_TIMEOUT", 900)) + 60
+NOTEBOOK_HTML_TTL = int(os.environ.get("NOTEBOOK_HTML_TTL", 30 * 24 * 3600))
+NOTEBOOK_HTML_PREFIX = f"notebook_html:{nbconvert_version}"  # re-export on upgrade
 COMPONENTS = {"structures", "tables", "attachments"}
+clients = LRUCache(maxsize=int(os.environ.get("PORTAL_MAX_CLIENTS", 64)))
+clients_lock = Lock()
 j2h = Json2Html()
 s3_client = boto3.client("s3")
 lambda_client = boto3.client("lambda")
@@ -66,6 +77,24 @@ def client_kwargs(request):
     return {"headers": get_consumer(request)}
 
 
+def get_client(headers=None):
+    """pooled client per consumer to skip healthcheck, spec and session setup
+
+    NOTE keyed by all consumer headers since client specs are expanded for the
+    projects accessible to the consumer and its session sends the headers
+    """
+    key = json.dumps(headers or {}, sort_keys=True)
+    with clients_lock:
+        client = clients.get(key)
+
+    if client is None:
+        client = Client(headers=headers)
+        with clients_lock:
+            clients[key] = client
+
+    return client
+
+
 def get_context(request):
     ctx = RequestContext(request)
     parsed_url = urllib.parse.urlparse(request.build_absolute_uri())
@@ -99,7 +128,7 @@ def landingpage(request, project):
     ctx = get_context(request)
 
     try:
-        client = Client(**ckwargs)
+        client = get_client(**ckwargs)
         prov = client.get_project(project)
     except HTTPNotFound:
         ctx["alert"] = f"Project '{project}' not found or access denied! Try to log in."
@@ -186,10 +215,29 @@ def export_notebook(nb, cid):
     return html_exporter.from_notebook_node(nb)
 
 
+def get_notebook_html(client, nid, cid):
+    """notebook exported to HTML once per notebook version (rebuilds get new ids)"""
+    key = f"{NOTEBOOK_HTML_PREFIX}:{nid}"
+    try:
+        html = redis_store.get(key)
+    except RedisError:
+        html = None
+
+    if html is None:
+        nb = client.notebooks.getNotebookById(pk=nid, _fields=["_all"]).result()
+        html, _ = export_notebook(nb, cid)
+        try:
+            redis_store.set(key, html, ex=NOTEBOOK_HTML_TTL)
+        except RedisError:
+            pass
+
+    return html
+
+
 def contribution(request, cid):
     ckwargs = client_kwargs(request)
     ctx = get_context(request)
-    client = Client(**ckwargs)
+    client = get_client(**ckwargs)
 
     try:
         contrib = client.contributions.getContributionById(
@@ -199,100 +247,69 @@ def contribution(request, cid):
         return HttpResponse(f"Contribution {cid} not found.", status=404)
 
     if "notebook" not in contrib or contrib.get("needs_build", True):
+        # prioritize (re)build in API's queue and show outdated notebook meanwhile
         url = f"{client.url}/notebooks/build"
-        r = requests.get(url, params={"cids": cid, "force": True})
-        if r.status_code == requests.codes.ok:
-            status = r.json().get("result", {}).get("status")
-            if status != "COMPLETED":
-                ctx["alert"] = f"Notebook build failed with status {status}"
-                return render(request, "contribution.html", ctx.flatten())
-
-            contrib = client.contributions.getContributionById(
-                pk=cid, _fields=["identifier", "notebook"]
-            ).result()
-        else:
+        r = requests.get(url, params={"cids": cid})
+        if r.status_code != requests.codes.ok:
             ctx["alert"] = f"Notebook build failed with status {r.status_code}"
             return render(request, "contribution.html", ctx.flatten())
 
+        if "notebook" not in contrib:
+            ctx["alert"] = "Notebook is being built. Please reload in a few seconds."
+            return render(request, "contribution.html", ctx.flatten())
+
+        ctx["alert"] = "Notebook is being updated. Reload to see latest changes."
+
     nid = contrib["notebook"]["id"]
-    try:
-        nb = client.notebooks.getNotebookById(pk=nid, _fields=["_all"]).result()
-    except HTTPNotFound:
-        return HttpResponse(f"Notebook {nid} not found.", status=404)
+    # page depends on notebook and portal versions, alert and consumer (header/footer)
+    version = getattr(portal, "__version__", None)
+    variant = [nid, version, ctx.get("alert"), ckwargs["headers"], request.get_host()]
+    etag = '"{}"'.format(md5(json.dumps(variant).encode("utf-8")).hexdigest())
+    if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+        response = HttpResponse(status=304)
+    else:
+        try:
+            ctx["nb"] = get_notebook_html(client, nid, cid)
+        except HTTPNotFound:
+            return HttpResponse(f"Notebook {nid} not found.", status=404)
 
-    ctx["identifier"], ctx["cid"] = contrib["identifier"], cid
-    ctx["nb"], _ = export_notebook(nb, cid)
+        ctx["identifier"], ctx["cid"] = contrib["identifier"], cid
+        response = render(request, "contribution.html", ctx.flatten())
 
-    return render(request, "contribution.html", ctx.flatten())
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, no-cache"  # revalidate access and version
+    return response
 
 
-def show_component(request, oid):
+def get_component(request, oid, download=False):
+    """resolve component type and info (or download) in a single API request"""
     ckwargs = client_kwargs(request)
-    resp = None
-    client = Client(**ckwargs)
+    client = get_client(**ckwargs)
+    url = f"{client.url}/contributions/component/{oid}"
+    params = {"download": 1} if download else None
+    return requests.get(url, params=params, headers=ckwargs["headers"])
 
-    try:
-        resp = client.get_structure(oid)
-    except HTTPNotFound:
-        try:
-            resp = client.get_table(oid)
-        except HTTPNotFound:
-            try:
-                resp = client.get_attachment(oid)
-            except HTTPNotFound:
-                return HttpResponse(
-                    f"Component with ObjectId {oid} not found.", status=404
-                )
 
-    if resp is not None:
-        return HttpResponse(resp.info().display())
+def show_component(request, oid):
+    r = get_component(request, oid)
+    if r.status_code != requests.codes.ok:
+        return HttpResponse(f"Component with ObjectId {oid} not found.", status=404)
 
-    return HttpResponse(status=404)
+    return HttpResponse(Dict(r.json()["info"]).display())
 
 
 def download_component(request, oid):
-    ckwargs = client_kwargs(request)
-    content = None
-    client = Client(**ckwargs)
-
-    try:
-        resp = client.structures.getStructureById(
-            pk=oid, _fields=["name", "cif"]
-        ).result()
-        name = resp["name"]
-        content = gzip.compress(bytes(resp["cif"], "utf-8"))
-        content_type = "application/gzip"
-        filename = f"{oid}_{name}.cif.gz"
-    except HTTPNotFound:
-        try:
-            resp = client.get_table(oid)
-            content = gzip.compress(bytes(resp.to_csv(), "utf-8"))
-            resp = client.tables.getTableById(pk=oid, _fields=["name"]).result()
-            name = resp["name"]
-            content_type = "application/gzip"
-            filename = f"{oid}_{name}.csv.gz"
-        except HTTPNotFound:
-            try:
-                resp = client.get_attachment(oid)
-                name = resp["name"]
-                content = resp.decode()
-                content_type = resp["mime"]
-                filename = f"{oid}_{name}"
-            except HTTPNotFound:
-                return HttpResponse(
-                    f"Component with ObjectId {oid} not found.", status=404
-                )
-
-    if content:
-        response = HttpResponse(content, content_type=content_type)
-        response["Content-Disposition"] = f"attachment; filename={filename}"
-        return response
+    r = get_component(request, oid, download=True)
+    if r.status_code != requests.codes.ok:
+        return HttpResponse(f"Component with ObjectId {oid} not found.", status=404)
 
-    return HttpResponse(status=404)
+    response = HttpResponse(r.content, content_type=r.headers["Content-Type"])
+    response["Content-Disposition"] = r.headers["Content-Disposition"]
+    return response
 
 
 def download_contribution(request, cid):
-    client = Client(**client_kwargs(request))
+    client = get_client(**client_kwargs(request))
     # NOTE gevent and FuturesSession don't play nice -> use query_contributions for now
     # TODO might need to switch client to use httpx instead of requests_futures
     contributions = client.query_contributions(query={"id": cid}, fields=["_all"])
@@ -351,7 +368,7 @@ def _get_download(key, content_type="application/zip"):
 def _reconcile_include(request, project: str, fields: list):
     ckwargs = client_kwargs(request)
     avail_components = set()
-    client = Client(**ckwargs)
+    client = get_client(**ckwargs)
     info = client.projects.getProjectByName(pk=project, _fields=["columns"]).result()
 
     for column in info["columns"]:
@@ -430,7 +447,7 @@ def create_download(request):
 
 
 def make_download(headers, query, include=None):
-    client = Client(headers=headers)
+    client = get_client(headers=headers)
     include = include or []
     key = _get_download_key(query, include)
     total_count, total_pages = client.get_totals(query=query, op="download")
@@ -482,6 +499,9 @@ def make_download(headers, query, include=None):
                     status = "SUBMITTED"
                     json_resp["status"] = status
                     redis_store.set(redis_key, status)
+                    redis_store.set(
+                        f"{redis_key}:heartbeat", 1, ex=DOWNLOAD_HEARTBEAT_TTL
+                    )
                 else:
                     status = "ERROR"
                     json_resp["status"] = status
@@ -492,6 +512,14 @@ def make_download(headers, query, include=None):
                 json_resp["status"] = status
                 json_resp["error"] = str(e)
                 redis_store.set(redis_key, status)
+        elif status not in {"READY", "ERROR"} and not redis_store.exists(
+            f"{redis_key}:heartbeat"
+        ):
+            # lambda invocation killed (e.g. hard timeout) without setting status
+            status = "ERROR"
+            json_resp["status"] = status
+            json_resp["error"] = "Download generation stalled"
+            redis_store.set(redis_key, status)
         else:
             json_resp["status"] = status
 
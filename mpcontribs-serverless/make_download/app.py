@@ -1,62 +1,355 @@
 # TODO ddtrace
+import io
 import os
 import json
+import time
 import logging
 import boto3
 
+from math import ceil
+from zlib import crc32
 from redis import Redis
-from pathlib import Path
-from shutil import make_archive, rmtree
-from mpcontribs.client import Client
+from zipfile import ZipFile, ZipInfo
+from concurrent.futures import as_completed
+from mpcontribs.client import Client, COMPONENTS, MAX_WORKERS, get_md5
 
 logger = logging.getLogger()
 logger.setLevel(os.environ["MPCONTRIBS_CLIENT_LOG_LEVEL"])
-s3_client = boto3.client('s3')
-timeout = int(os.environ["LAMBDA_TIMEOUT"])
+# S3_ENDPOINT_URL to run against local S3 stand-in (e.g. moto server or minio)
+s3_client = boto3.client('s3', endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None)
+lambda_client = boto3.client("lambda")
+MIN_PART_SIZE = 5 * 1024**2  # S3 minimum for all but the last part
+PART_SIZE = max(int(os.environ.get("S3_PART_SIZE", 16 * 1024**2)), MIN_PART_SIZE)
+SHARDS = int(os.environ.get("DOWNLOAD_SHARDS", 8))  # max. parallel invocations
+MIN_REMAINING = 10  # seconds left in invocation to checkpoint shard and resume
+STATE_TTL = 24 * 3600  # seconds to keep shard state in redis
+# in-progress status without heartbeat for longer than an invocation is stale
+HEARTBEAT_TTL = int(os.environ["LAMBDA_TIMEOUT"]) + 60
 redis_address = os.environ["REDIS_ADDRESS"]
 store = Redis.from_url(f"redis://{redis_address}")
 store.ping()
 
-def get_remaining(event, context):
-    remaining = context.get_remaining_time_in_millis() / 1000. - 0.5
-    if remaining < 3:
-        raise ValueError("TIMEOUT in 3s!")
 
-    elapsed_pct = (timeout - remaining) / timeout * 100.
-    store.set(event["redis_key"], f"{elapsed_pct:.1f}")
-    return remaining
+class MultipartUpload:
+    """write-only file object uploading to S3 in parts of bounded size"""
+
+    def __init__(self, bucket, key, part_size=PART_SIZE, **kwargs):
+        self.bucket, self.key, self.part_size = bucket, key, part_size
+        resp = s3_client.create_multipart_upload(Bucket=bucket, Key=key, **kwargs)
+        self.upload_id = resp["UploadId"]
+        self.parts, self.buffer, self.offset = [], bytearray(), 0
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset):
+        # only for ZipFile to write central directory at current offset
+        if offset != self.offset:
+            raise io.UnsupportedOperation("seek")
+
+        return offset
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+
+        return len(data)
+
+    def flush(self):
+        pass  # parts uploaded once full
+
+    def upload_part(self, body):
+        number = len(self.parts) + 1
+        resp = s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=number, Body=bytes(body)
+        )
+        self.parts.append({"ETag": resp["ETag"], "PartNumber": number})
+
+    def read(self, key, start, end):
+        resp = s3_client.get_object(
+            Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}"
+        )
+        self.write(resp["Body"].read())
+
+    def copy(self, key, size):
+        """append object of given size, server-side where parts are large enough"""
+        start = 0
+        if self.buffer:  # fill up pending part first
+            start = min(size, self.part_size - len(self.buffer))
+            self.read(key, 0, start)
+
+        if size - start >= MIN_PART_SIZE:
+            number = len(self.parts) + 1
+            resp = s3_client.upload_part_copy(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                PartNumber=number, CopySource={"Bucket": self.bucket, "Key": key},
+                CopySourceRange=f"bytes={start}-{size - 1}"
+            )
+            etag = resp["CopyPartResult"]["ETag"]
+            self.parts.append({"ETag": etag, "PartNumber": number})
+            self.offset += size - start
+        elif start < size:
+            self.read(key, start, size)
+
+    def complete(self):
+        if self.buffer or not self.parts:
+            self.upload_part(self.buffer)  # last part can be smaller
+            self.buffer.clear()
+
+        s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        s3_client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+def get_remaining(context):
+    return context.get_remaining_time_in_millis() / 1000.
+
+
+def get_pages(client, resource, ids, fmt):
+    """zip entry names and queries for download pages of resource
+
+    Entries are named as the files of `Client.download_contributions`.
+    """
+    model = client.get_model(f"{resource.capitalize()}Schema")
+    fields = list(model._properties.keys())
+    query = {"format": fmt, "_fields": fields, "id__in": sorted(ids)}
+    _, total_pages = client.get_totals(query=query, resource=resource, op="download")
+    queries = client._split_query(
+        query, resource=resource, op="download", pages=total_pages
+    )
+    pages = []
+
+    for q in queries:
+        digest = get_md5({"ids": q["id__in"].split(",")})
+        pages.append([f"{resource}/{digest}.{fmt}.gz", q])
+
+    return pages
+
+
+def get_plan(client, query, include):
+    """download pages for contributions and included components split into shards"""
+    fmt = query.get("format", "json")
+    components = [c for c in COMPONENTS if c in include]
+    all_ids = client.get_all_ids(query, include=components)
+    pages = []
+
+    for name, values in all_ids.items():
+        resources = [(c, values[c]["ids"]) for c in components]
+        resources.append(("contributions", values["ids"]))
+        for resource, ids in resources:
+            if ids:
+                pages += get_pages(client, resource, ids, fmt)
+                logger.debug(f"{len(ids)} {resource} for '{name}' planned.")
+
+    # shards of at least MAX_WORKERS pages each
+    nshards = max(min(SHARDS, ceil(len(pages) / MAX_WORKERS)), 1)
+    size = ceil(len(pages) / nshards)
+    return [pages[idx:idx + size] for idx in range(0, len(pages), size)] or [[]]
+
+
+def write_entry(upload, entries, name, data):
+    """append zip entry (local header and stored data) to upload"""
+    info = ZipInfo(name, date_time=time.localtime()[:6])
+    info.external_attr = 0o600 << 16  # as in ZipFile.writestr
+    info.CRC, info.compress_size, info.file_size = crc32(data), len(data), len(data)
+    info.header_offset = upload.tell()
+    upload.write(info.FileHeader() + data)
+    entries.append([name, info.date_time, info.CRC, info.file_size, info.header_offset])
+
+
+def load_entries(entries, offset):
+    """ZipInfo for entries recorded by `write_entry` in segment at offset"""
+    for name, date_time, crc, size, header_offset in entries:
+        info = ZipInfo(name, date_time=tuple(date_time))
+        info.external_attr = 0o600 << 16
+        info.CRC, info.compress_size, info.file_size = crc, size, size
+        info.header_offset = offset + header_offset
+        yield info
+
+
+def get_keys(redis_key):
+    """redis keys for state of download generation"""
+    return {
+        k: f"{redis_key}:{k}"
+        for k in ["shards", "progress", "finished", "pages", "done", "error"]
+    }
+
+
+def heartbeat(redis_key):
+    store.set(f"{redis_key}:heartbeat", 1, ex=HEARTBEAT_TTL)
+
+
+def set_status(redis_key, status):
+    keys = get_keys(redis_key)
+    heartbeat(redis_key)
+    if status == "ERROR":
+        store.set(keys["error"], 1, ex=STATE_TTL)
+
+    store.set(redis_key, status)
+    # shards could still be reporting progress
+    if status != "ERROR" and store.exists(keys["error"]):
+        store.set(redis_key, "ERROR")
+        raise ValueError("download generation failed in other shard")
+
+
+def invoke(context, event):
+    lambda_client.invoke(
+        FunctionName=context.function_name, InvocationType="Event",
+        Payload=json.dumps(event)
+    )
+
+
+def write_shard(client, event, context):
+    """download pages of shard in batches, checkpointing segments to resume from
+
+    Completed pages are written as zip entries into a separate S3 object (segment)
+    per invocation. The shard invokes itself to continue in a new segment if the
+    invocation is about to time out. Returns whether all shards are finished.
+    """
+    redis_key, shard = event["redis_key"], event["shard"]
+    bucket, filename, fmt, version = redis_key.split(":")
+    keys = get_keys(redis_key)
+    pages = json.loads(store.hget(keys["shards"], shard))
+    total_pages = int(store.get(keys["pages"]))
+    progress = store.hget(keys["progress"], shard)
+    progress = json.loads(progress) if progress else {"pages": 0, "segments": []}
+    segment = len(progress["segments"])
+    segment_key = f"shards/{filename}_{fmt}/{version}/{shard}.{segment}"
+    upload, entries, batch_time = MultipartUpload(bucket, segment_key), [], 0
+
+    try:
+        # bounded number of pages in flight/memory
+        for idx in range(progress["pages"], len(pages), MAX_WORKERS):
+            tic, batch = time.perf_counter(), pages[idx:idx + MAX_WORKERS]
+            futures = [
+                client._get_future(
+                    name, q, rel_url=f"{name.split('/', 1)[0]}/download/gz"
+                )
+                for name, q in batch
+            ]
+            for future in as_completed(futures):
+                resp = future.result()
+                resp.raise_for_status()
+                write_entry(upload, entries, future.track_id, resp.result)
+
+            progress["pages"] += len(batch)
+            done = store.incrby(keys["done"], len(batch))
+            set_status(redis_key, f"{done / total_pages * 100.:.1f}")
+            batch_time = max(batch_time, time.perf_counter() - tic)
+            if get_remaining(context) < 2 * batch_time + MIN_REMAINING:
+                break
+
+        if entries:
+            upload.complete()
+            progress["segments"].append([segment_key, upload.tell(), entries])
+        else:
+            upload.abort()
+    except Exception:
+        upload.abort()
+        raise
+
+    store.hset(keys["progress"], shard, json.dumps(progress))  # checkpoint
+    if progress["pages"] < len(pages):
+        logger.info(f"shard {shard}: {progress['pages']}/{len(pages)} pages, resuming.")
+        invoke(context, event)
+        return False
+
+    # fan-in: last shard to finish merges
+    pipe = store.pipeline()
+    pipe.sadd(keys["finished"], shard)
+    pipe.scard(keys["finished"])
+    added, finished = pipe.execute()
+    return bool(added) and finished == store.hlen(keys["shards"])
+
+
+def merge_shards(event):
+    """concatenate shard segments into zip file on S3 and write central directory"""
+    redis_key = event["redis_key"]
+    bucket, filename, fmt, version = redis_key.split(":")
+    keys = get_keys(redis_key)
+    segments, infos = [], []
+    upload = MultipartUpload(
+        bucket, f"{filename}_{fmt}.zip",
+        Metadata={"version": version}, ContentType="application/zip"
+    )
+
+    try:
+        for shard in range(store.hlen(keys["shards"])):
+            progress = json.loads(store.hget(keys["progress"], shard))
+            for segment_key, size, entries in progress["segments"]:
+                infos += load_entries(entries, upload.tell())
+                upload.copy(segment_key, size)
+                segments.append({"Key": segment_key})
+
+        with ZipFile(upload, "w") as zf:  # central directory only
+            zf.filelist += infos
+
+        upload.complete()
+    except Exception:
+        upload.abort()
+        raise
+
+    for idx in range(0, len(segments), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket, Delete={"Objects": segments[idx:idx + 1000]}
+        )
 
 
 def lambda_handler(event, context):
-    get_remaining(event, context)
+    """plan download and fan out shards, continue shard, or merge shards
+
+    The initial invocation splits the download pages into shards, records them in
+    redis, invokes itself for all but the first shard and then processes the first
+    shard. The invocation finishing the last shard invokes the merge into the zip
+    file, so that the merge gets the full timeout.
+    """
+    redis_key = event["redis_key"]
     query, include = event["query"], event["include"]
-    project = query["project"]
-    bucket, filename, fmt, version = event["redis_key"].split(":")
+    keys = get_keys(redis_key)
+    heartbeat(redis_key)
 
     try:
+        if event.get("merge"):
+            merge_shards(event)
+            store.delete(*keys.values())
+            store.set(redis_key, "READY")
+            return
+
         client = Client(
-            host=event["host"], headers=event["headers"], project=project
-        )
-        remaining = get_remaining(event, context)
-        tmpdir = Path("/tmp")
-        outdir = tmpdir / filename
-        ndownloads = client.download_contributions(
-            query=query, include=include, outdir=outdir, timeout=remaining
-        )
-        get_remaining(event, context)
-        make_archive(outdir, "zip", outdir)
-        get_remaining(event, context)
-        zipfile = outdir.with_suffix(".zip")
-        resp = zipfile.read_bytes()
-        s3_client.put_object(
-            Bucket=bucket, Key=f"{filename}_{fmt}.zip",
-            Metadata={"version": version},
-            Body=resp, ContentType="application/zip"
+            host=event["host"], headers=event["headers"], project=query["project"]
         )
-        get_remaining(event, context)
-        rmtree(outdir)
-        os.remove(zipfile)
-        store.set(event["redis_key"], "READY")
+
+        if "shard" not in event:
+            shards = get_plan(client, query, include)
+            pipe = store.pipeline()
+            pipe.delete(*keys.values())
+            pipe.hset(keys["shards"], mapping={
+                shard: json.dumps(pages) for shard, pages in enumerate(shards)
+            })
+            pipe.set(keys["pages"], sum(len(pages) for pages in shards) or 1)
+            pipe.set(keys["done"], 0)
+            for key in keys.values():
+                pipe.expire(key, STATE_TTL)
+            pipe.execute()
+            set_status(redis_key, "0.0")
+
+            for shard in range(1, len(shards)):
+                invoke(context, dict(event, shard=shard))
+
+            event = dict(event, shard=0)
+
+        if write_shard(client, event, context):
+            invoke(context, dict(event, merge=True))
     except Exception as e:
         logger.error(str(e), exc_info=True)
-        store.set(event["redis_key"], "ERROR")
+        set_status(redis_key, "ERROR")
@@ -0,0 +1,33 @@
+import os
+import sys
+import boto3
+import pytest
+import fakeredis
+import importlib
+
+from unittest import mock
+from moto import mock_aws
+
+BUCKET = "mpcontribs-downloads"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.update(
+    AWS_ACCESS_KEY_ID="testing",
+    AWS_SECRET_ACCESS_KEY="testing",
+    AWS_DEFAULT_REGION="us-east-1",
+)
+os.environ.setdefault("MPCONTRIBS_CLIENT_LOG_LEVEL", "INFO")
+os.environ.setdefault("LAMBDA_TIMEOUT", "900")
+os.environ.setdefault("REDIS_ADDRESS", "localhost:6379")
+os.environ.pop("S3_ENDPOINT_URL", None)
+
+
+@pytest.fixture()
+def app():
+    """make_download module with S3 mocked by moto and redis by fakeredis"""
+    store = fakeredis.FakeStrictRedis()
+    with mock_aws(), mock.patch("redis.Redis.from_url", return_value=store):
+        module = importlib.import_module("make_download.app")
+        module = importlib.reload(module)  # clients and store created in mocks
+        boto3.client("s3").create_bucket(Bucket=BUCKET)
+        yield module
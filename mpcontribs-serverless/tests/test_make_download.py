@@ -0,0 +1,177 @@
+import io
+import random
+
+from zipfile import ZipFile
+from unittest import mock
+from concurrent.futures import Future
+
+from conftest import BUCKET
+
+
+def get_body(name, size):
+    return random.Random(name).randbytes(size)
+
+
+def get_object(app, key):
+    return app.s3_client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def test_stream_zip(app):
+    upload = app.MultipartUpload(BUCKET, "stream.zip", part_size=app.MIN_PART_SIZE)
+    bodies = {f"contributions/{idx}.json.gz": get_body(idx, 2 * 1024**2) for idx in range(6)}
+    entries = []
+
+    for name, body in bodies.items():
+        app.write_entry(upload, entries, name, body)
+
+    with ZipFile(upload, "w") as zf:  # central directory only
+        zf.filelist += app.load_entries(entries, 0)
+
+    upload.complete()
+    assert len(upload.parts) == 3  # 2x5MB + remainder
+
+    with ZipFile(io.BytesIO(get_object(app, "stream.zip"))) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == list(bodies)
+        assert all(zf.read(name) == body for name, body in bodies.items())
+
+
+EVENT = {
+    "redis_key": f"{BUCKET}:proj:json:2",
+    "host": "contribs-api.materialsproject.org",
+    "headers": {},
+    "query": {"project": "proj", "format": "json"},
+    "include": [],
+}
+
+
+class Response:
+    def __init__(self, body, failed=False):
+        self.result, self.failed = body, failed
+
+    def raise_for_status(self):
+        if self.failed:
+            raise ValueError("500 Server Error")
+
+
+class Model:
+    _properties = {"id": {}, "data": {}}
+
+
+class Client:
+    """stand-in for mpcontribs.client.Client serving download pages of given size"""
+
+    def __init__(self, ncontribs, size, per_page=10, fail=None):
+        self.ids = {f"{idx:024x}" for idx in range(ncontribs)}
+        self.size, self.per_page, self.fail = size, per_page, fail
+        self.bodies, self.requests = {}, 0
+
+    def get_all_ids(self, query, include=None):
+        return {query["project"]: {"ids": self.ids}}
+
+    def get_model(self, name):
+        return Model
+
+    def get_totals(self, query=None, resource=None, op=None):
+        return len(query["id__in"]), -(-len(query["id__in"]) // self.per_page)
+
+    def _split_query(self, query, resource=None, op=None, pages=None):
+        ids = query["id__in"]
+        return [
+            dict(query, id__in=",".join(ids[idx:idx + self.per_page]))
+            for idx in range(0, len(ids), self.per_page)
+        ]
+
+    def _get_future(self, track_id, params, rel_url=None):
+        failed = self.requests == self.fail  # n-th request fails
+        self.requests += 1
+        self.bodies[track_id] = get_body(track_id, self.size)
+        future = Future()
+        future.track_id = track_id
+        future.set_result(Response(self.bodies[track_id], failed=failed))
+        return future
+
+
+class Context:
+    function_name = "make_download"
+
+    def __init__(self, remaining=900):
+        self.remaining = remaining  # seconds
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining * 1000
+
+
+def run(app, monkeypatch, client, context):
+    """run initial invocation and all invocations it triggers, return their events"""
+    pending, events = [EVENT], []
+    monkeypatch.setattr(app, "Client", lambda **kwargs: client)
+    monkeypatch.setattr(app, "invoke", lambda context, event: pending.append(event))
+
+    while pending:
+        events.append(pending.pop(0))
+        app.lambda_handler(events[-1], context)
+
+    return events
+
+
+def check_zip(app, client):
+    with ZipFile(io.BytesIO(get_object(app, "proj_json.zip"))) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(client.bodies)
+        assert all(zf.read(name) == body for name, body in client.bodies.items())
+
+    segments = app.s3_client.list_objects_v2(Bucket=BUCKET, Prefix="shards/")
+    assert segments["KeyCount"] == 0  # removed after merge
+
+
+def spy(app, method):
+    client_method = getattr(app.s3_client, method)
+    return mock.patch.object(app.s3_client, method, wraps=client_method)
+
+
+def test_merge_copied_segments(app, monkeypatch):
+    # 6 pages in 2 shards, 6MB segments merged with server-side part copies
+    client = Client(ncontribs=60, size=2 * 1024**2)
+
+    with spy(app, "upload_part_copy") as upload_part_copy:
+        events = run(app, monkeypatch, client, Context())
+
+    # plan and shard 0, shard 1, merge invoked by shard 1
+    assert [(e.get("shard"), e.get("merge")) for e in events] == [
+        (None, None), (1, None), (1, True)
+    ]
+    assert upload_part_copy.call_count == 2
+    assert app.store.get(EVENT["redis_key"]) == b"READY"
+    check_zip(app, client)
+
+
+def test_resume_and_merge_read_segments(app, monkeypatch):
+    # single shard about to time out after every batch of 3 pages
+    monkeypatch.setattr(app, "SHARDS", 1)
+    client = Client(ncontribs=200, size=1024)
+
+    with spy(app, "upload_part_copy") as upload_part_copy:
+        with spy(app, "get_object") as get_object:
+            events = run(app, monkeypatch, client, Context(remaining=5))
+
+    assert len(events) == 1 + 6 + 1  # 20 pages in 7 invocations, merge
+    assert [e.get("shard") for e in events[1:-1]] == [0] * 6
+    assert upload_part_copy.call_count == 0  # segments too small to copy
+    assert get_object.call_count == 7
+    assert app.store.get(EVENT["redis_key"]) == b"READY"
+    check_zip(app, client)
+
+
+def test_error_in_one_shard(app, monkeypatch):
+    # first page of shard 0 fails, shard 1 stops on error of shard 0
+    client = Client(ncontribs=60, size=1024, fail=0)
+    events = run(app, monkeypatch, client, Context())
+
+    assert not any(e.get("merge") for e in events)
+    assert app.store.get(EVENT["redis_key"]) == b"ERROR"
+    assert app.store.exists(f"{EVENT['redis_key']}:heartbeat")
+    uploads = app.s3_client.list_multipart_uploads(Bucket=BUCKET)
+    assert not uploads.get("Uploads")  # aborted
+    objects = app.s3_client.list_objects_v2(Bucket=BUCKET)
+    assert objects["KeyCount"] == 0